@@ -4,6 +4,8 @@ import io
 import random
 import time
 
+from src.agent.context_compactor import ContextCompactor
+from src.agent.reply_stream import ReplyStream
 from src.api.aws_api import aws_api_async
 from src.api.interface.image2text_api_interface import Image2TextAPIInterfaceAsync
 from src.api.interface.llm_api_interface import LLMAPIInterfaceAsync
@@ -15,6 +17,7 @@ from src.api.nvidia_playground_api_async import nvidia_playground_api_async
 from src.api.openai_api import openai_api
 from src.data.Message import MessageType, Message, chat_message_store
 from src.agent.user_session import UserSession
+from src.utils.config import config
 from src.utils.constants import new_message, Role
 from src.utils.logger import logger
 from src.utils.utils import remove_think_tag, get_image_prompt, remove_image_prompt, remove_quotes
@@ -27,14 +30,28 @@ class AgentService:
         self.image2text_api: Image2TextAPIInterfaceAsync = nvidia_playground_api_async
         self.speech2text_api: Speech2TextAPIInterfaceAsync = openai_api
         self.text2image_api: Text2ImageAPIInterfaceAsync = nvidia_playground_api_async
+        self.context_compactor = ContextCompactor(self.llm_api,
+                                                  batch_turns=config.user_session_settings["summary_batch_turns"],
+                                                  concurrency=config.user_session_settings["summary_concurrency"],
+                                                  max_words=config.user_session_settings["summary_max_words"])
+        self.stream_replies: bool = config.user_session_settings["stream_replies"]
 
     async def generate_reply(self, user_session: UserSession, user_message: str,
                              expected_message_type: MessageType = MessageType.ANY) -> Message:
         user_session.add_user_context(user_message)
         memories = user_session.recall_memory(user_message)
+        # Voice: 15% chance of sending voice message
+        reply_with_voice = (expected_message_type == MessageType.ANY
+                            and user_session.reply_with_voice and random.random() < 0.15)
+        if self.stream_replies and not reply_with_voice and expected_message_type in (MessageType.ANY, MessageType.TEXT):
+            return await self.stream_text_reply(user_session, user_message,
+                                                with_image=expected_message_type == MessageType.ANY)
+        # Cancelling the reply before it is added to the context (e.g. because the user sent
+        # another message meanwhile) leaves nothing behind but the user's turn: nothing is
+        # enqueued, so nothing is delivered or charged
         ai_reply: str = await self.generate_text_response(user_session)
         ai_reply = remove_think_tag(ai_reply)
-        user_session.add_bot_context(ai_reply)
+        raw_reply = ai_reply
         image_prompt = get_image_prompt(ai_reply)
         if image_prompt != "":
             ai_reply = remove_image_prompt(ai_reply)
@@ -43,55 +60,111 @@ class AgentService:
         try:
             match expected_message_type:
                 case MessageType.ANY:
-                    # Voice: 15% chance of sending voice message
-                    if user_session.reply_with_voice and random.random() < 0.15:
+                    if reply_with_voice:
                         voice = await self.tts_api.text_to_speech(ai_reply, "Ruth")
                         message = Message(MessageType.VOICE, voice, user_message, user_session.user_id)
-                        chat_message_store.enqueue(user_session.user_id, message)
                     else:
                         # Text
                         message = Message(MessageType.TEXT, ai_reply, user_message, user_session.user_id)
-                        chat_message_store.enqueue(user_session.user_id, message)
+                    self.add_reply_context(user_session, raw_reply)
+                    await chat_message_store.enqueue(user_session.user_id, message)
                     # Image
                     if image_prompt != "" and user_session.enable_image:
                         image_message = await self.generate_image(user_session, image_prompt)
-                        chat_message_store.enqueue(user_session.user_id, image_message)
+                        await chat_message_store.enqueue(user_session.user_id, image_message)
                     return message
                 case MessageType.TEXT:
                     message = Message(MessageType.TEXT, ai_reply, user_message, user_session.user_id)
-                    chat_message_store.enqueue(user_session.user_id, message)
+                    self.add_reply_context(user_session, raw_reply)
+                    await chat_message_store.enqueue(user_session.user_id, message)
                     return message
                 case MessageType.VOICE:
                     voice = await self.tts_api.text_to_speech(ai_reply, "Ruth")
                     message = Message(MessageType.VOICE, voice, user_message, user_session.user_id)
-                    chat_message_store.enqueue(user_session.user_id, message)
+                    self.add_reply_context(user_session, raw_reply)
+                    await chat_message_store.enqueue(user_session.user_id, message)
                     return message
                 case MessageType.IMAGE:
+                    self.add_reply_context(user_session, raw_reply)
                     # Image
                     if image_prompt != "" and user_session.enable_image:
                         image_message = await self.generate_image(user_session, image_prompt)
-                        chat_message_store.enqueue(user_session.user_id, image_message)
+                        await chat_message_store.enqueue(user_session.user_id, image_message)
                         return image_message
                     else:
                         return Message(MessageType.NONE, ai_reply, user_message, user_session.user_id)
                 case _:
+                    self.add_reply_context(user_session, raw_reply)
                     logger.error(f"Unknown message type: {expected_message_type}")
                     return Message(MessageType.BAD_MESSAGE, ai_reply, user_message, user_session.user_id)
         except Exception as e:
             logger.error("An error happens when generating reply: " + str(e))
             return Message(MessageType.NONE, ai_reply, user_message, user_session.user_id)
 
+    async def stream_text_reply(self, user_session: UserSession, user_message: str, with_image: bool) -> Message:
+        """
+        Like the text reply of generate_reply, but every group of sentences is enqueued as soon as
+        the LLM has generated it, so the first one is delivered long before the reply is finished.
+        Only the first part is charged. Returns the whole reply as one message.
+        """
+        start_time = time.time()
+        logger.info(f"====={self.llm_api.api_name} streaming text response...")
+        token_budget = self.get_context_token_budget()
+        user_session.fit_context(token_budget)
+        context = user_session.context_window.to_messages(token_budget)
+        reply_stream = ReplyStream(self.llm_api.generate_text_response_stream(context))
+        sent = []
+        try:
+            async for group in reply_stream.sentence_groups():
+                message = Message(MessageType.TEXT, group, user_message, user_session.user_id, billable=not sent)
+                await chat_message_store.enqueue(user_session.user_id, message)
+                if not sent:
+                    duration = round(time.time() - start_time, 1)
+                    logger.info(f"====={self.llm_api.api_name} takes {duration} seconds to the first message")
+                sent.append(group)
+        except asyncio.CancelledError:
+            # The user has seen the part that was sent
+            if sent:
+                self.add_reply_context(user_session, " ".join(sent))
+            raise
+        except Exception as e:
+            logger.error("An error happens when streaming reply: " + str(e))
+            if sent:
+                self.add_reply_context(user_session, " ".join(sent))
+            return Message(MessageType.NONE, " ".join(sent), user_message, user_session.user_id)
+        duration = round(time.time() - start_time, 1)
+        logger.info(f"====={self.llm_api.api_name} takes {duration} seconds to generate text")
+
+        ai_reply = reply_stream.reply
+        self.add_reply_context(user_session, ai_reply)
+        image_prompt = get_image_prompt(ai_reply)
+        if with_image and image_prompt != "" and user_session.enable_image:
+            image_message = await self.generate_image(user_session, image_prompt)
+            await chat_message_store.enqueue(user_session.user_id, image_message)
+        return Message(MessageType.TEXT, " ".join(sent), user_message, user_session.user_id)
+
+    def add_reply_context(self, user_session: UserSession, ai_reply: str):
+        user_session.add_bot_context(ai_reply)
+        self.context_compactor.schedule(user_session)
+
     async def generate_text_response(self, user_session: UserSession) -> str:
         start_time = time.time()
         logger.info(f"====={self.llm_api.api_name} generating text response...")
 
-        res = await self.llm_api.generate_text_response(user_session.context)
+        token_budget = self.get_context_token_budget()
+        user_session.fit_context(token_budget)
+        context = user_session.context_window.to_messages(token_budget)
+        res = await self.llm_api.generate_text_response(context)
 
         end_time = time.time()
         duration = round(end_time - start_time, 1)
         logger.info(f"====={self.llm_api.api_name} takes {duration} seconds to generate text")
         return res
 
+    def get_context_token_budget(self) -> int:
+        budgets = config.user_session_settings["context_token_budgets"]
+        return budgets.get(self.llm_api.model_name, budgets["default"])
+
     async def text2voice(self, user_session: UserSession, text: str) -> io.BytesIO:
         audio_file = await self.tts_api.text_to_speech(text, voice_id="Ruth")
         return audio_file
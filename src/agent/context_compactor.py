@@ -0,0 +1,83 @@
+import asyncio
+from typing import List, Set
+
+from src.agent.context_window import Turn
+from src.agent.user_session import UserSession
+from src.api.interface.llm_api_interface import LLMAPIInterfaceAsync
+from src.utils.constants import new_message, Role
+from src.utils.logger import logger
+from src.utils.utils import remove_think_tag
+
+
+class ContextCompactor:
+    """
+    Folds turns that fell out of a session's context window into a running summary, which
+    the window keeps next to the system prompt. Summaries are written by background tasks,
+    never on the reply path; at most `concurrency` of them call the LLM at once, and each
+    session has at most one in flight.
+    """
+
+    def __init__(self, llm_api: LLMAPIInterfaceAsync, batch_turns: int, concurrency: int, max_words: int):
+        self.llm_api = llm_api
+        self.batch_turns = batch_turns
+        self.max_words = max_words
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._in_progress: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def schedule(self, user_session: UserSession):
+        """Start compacting the session if enough turns are waiting and it is not being compacted already."""
+        if len(user_session.pending_summary_turns) < self.batch_turns:
+            return
+        if user_session.user_id in self._in_progress:
+            return
+        self._in_progress.add(user_session.user_id)
+        task = asyncio.create_task(self._compact(user_session))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, user_session: UserSession):
+        try:
+            async with self._semaphore:
+                epoch = user_session.context_epoch
+                turns = list(user_session.pending_summary_turns)
+                summary = await self.summarise(user_session.summary, turns)
+            if user_session.context_epoch != epoch:
+                # The context was cleared while we were summarising it
+                return
+            if not summary or summary.startswith(f"Bad response from {self.llm_api.api_name}"):
+                # Keep the turns for the next attempt rather than replacing the summary with nothing
+                logger.error(f"Got no usable summary for user {user_session.user_id}: {summary!r}")
+                return
+            user_session.set_summary(summary)
+            # By identity: turns may have been added, or dropped by the cap, while we were summarising
+            summarised = {id(turn) for turn in turns}
+            user_session.pending_summary_turns[:] = [turn for turn in user_session.pending_summary_turns
+                                                     if id(turn) not in summarised]
+            logger.info(f"Compacted {len(turns)} turns of user {user_session.user_id} into the summary")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to summarise the context of user {user_session.user_id}: {e}")
+            return
+        finally:
+            self._in_progress.discard(user_session.user_id)
+        # Turns that were evicted in the meantime
+        self.schedule(user_session)
+
+    async def summarise(self, summary: str, turns: List[Turn]) -> str:
+        conversation = "\n".join(f"{role.value}: {content}" for role, content in turns)
+        prompt = (
+            f"Update the summary of a conversation between the user and the assistant.\n"
+            f"Keep names, facts about the user, promises, plans and the emotional tone. "
+            f"Write at most {self.max_words} words in the assistant's perspective and reply with the summary only.\n\n"
+            f"Current summary:\n{summary or '(none)'}\n\n"
+            f"New part of the conversation:\n{conversation}"
+        )
+        res = await self.llm_api.generate_text_response([new_message(Role.USER, prompt)])
+        return remove_think_tag(res)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
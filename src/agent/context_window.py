@@ -0,0 +1,180 @@
+from array import array
+from typing import Dict, List, Optional, Iterator, Tuple
+
+from src.agent.token_counter import count_tokens, count_message_tokens, truncate_to_tokens, MESSAGE_OVERHEAD_TOKENS
+from src.utils.constants import Role, ROLE_CODES, ROLES_BY_CODE, new_message
+
+# A turn outside the window, e.g. one waiting to be summarised
+Turn = Tuple[Role, str]
+
+
+class ContextWindow:
+    """
+    The conversation context of a session: a pinned system slot, an optional summary of
+    older turns, and the last `capacity` turns, kept in a fixed-size ring buffer. Appending a
+    turn overwrites the oldest one in place once the window is full, so it costs O(1)
+    whatever the window size. Every turn's token count is computed once, when it is added.
+
+    Turns are stored compactly, as a role code and the content string in parallel arrays;
+    the {"role", "content"} dicts providers expect are only built by to_messages().
+    """
+    __slots__ = ("capacity", "_roles", "_contents", "_tokens", "_start", "_size",
+                 "_system_message", "_system_tokens", "_summary_message", "_summary_tokens")
+
+    def __init__(self, capacity: int, system_message: Dict):
+        if capacity < 1:
+            raise ValueError(f"Context window capacity must be at least 1, got {capacity}")
+        self.capacity = capacity
+        self._roles = bytearray(capacity)
+        self._contents: List[Optional[str]] = [None] * capacity
+        self._tokens = array("I", bytes(4 * capacity))
+        self._start = 0
+        self._size = 0
+        self.system_message = system_message
+        self.summary_message = None
+
+    @property
+    def system_message(self) -> Dict:
+        return self._system_message
+
+    @system_message.setter
+    def system_message(self, message: Dict):
+        self._system_message = message
+        self._system_tokens = count_message_tokens(message)
+
+    @property
+    def summary_message(self) -> Optional[Dict]:
+        return self._summary_message
+
+    @summary_message.setter
+    def summary_message(self, message: Optional[Dict]):
+        self._summary_message = message
+        self._summary_tokens = count_message_tokens(message) if message is not None else 0
+
+    def _pinned(self) -> List[Dict]:
+        if self._summary_message is None:
+            return [self._system_message]
+        return [self._system_message, self._summary_message]
+
+    def _message(self, index: int) -> Dict:
+        return new_message(ROLES_BY_CODE[self._roles[index]], self._contents[index])
+
+    def append(self, role: Role, content: str) -> Optional[Turn]:
+        """Add a turn. Returns the oldest turn if it had to make room for it, otherwise None."""
+        if self._size < self.capacity:
+            index = (self._start + self._size) % self.capacity
+            self._size += 1
+            evicted = None
+        else:
+            index = self._start
+            evicted = (ROLES_BY_CODE[self._roles[index]], self._contents[index])
+            self._start = (self._start + 1) % self.capacity
+        self._roles[index] = ROLE_CODES[role]
+        self._contents[index] = content
+        self._tokens[index] = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        return evicted
+
+    def evict_to_budget(self, token_budget: int) -> List[Turn]:
+        """
+        Remove the oldest turns until the whole window fits token_budget, keeping at least the
+        newest turn. Returns the removed turns, oldest first.
+        """
+        total = self.count_tokens()
+        evicted: List[Turn] = []
+        while self._size > 1 and total > token_budget:
+            index = self._start
+            evicted.append((ROLES_BY_CODE[self._roles[index]], self._contents[index]))
+            total -= self._tokens[index]
+            self._contents[index] = None
+            self._start = (self._start + 1) % self.capacity
+            self._size -= 1
+        return evicted
+
+    def clear(self):
+        self.summary_message = None
+        self._contents = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+
+    def turns(self) -> Iterator[Turn]:
+        """Turns from oldest to newest, without the system slot and the summary."""
+        for i in range(self._size):
+            index = (self._start + i) % self.capacity
+            yield ROLES_BY_CODE[self._roles[index]], self._contents[index]
+
+    def contents(self) -> Iterator[str]:
+        for i in range(self._size):
+            yield self._contents[(self._start + i) % self.capacity]
+
+    def to_messages(self, token_budget: Optional[int] = None) -> List[Dict]:
+        """
+        The message list for an LLM provider.
+
+        With a token budget, the oldest turns that do not fit are left out. The system slot, the
+        summary and the newest turn are always kept. If the newest turn does not fit next to the
+        pinned slots, the summary is cut down first, then the system prompt, then the turn.
+        """
+        if token_budget is None:
+            messages = self._pinned()
+            messages.extend(self._message((self._start + i) % self.capacity) for i in range(self._size))
+            return messages
+
+        remaining = token_budget - self._system_tokens - self._summary_tokens
+        newest = (self._start + self._size - 1) % self.capacity
+        if self._size > 0 and self._tokens[newest] > remaining:
+            return self._fit_newest_turn(token_budget)
+        included: List[Dict] = []
+        for i in range(self._size - 1, -1, -1):
+            index = (self._start + i) % self.capacity
+            tokens = self._tokens[index]
+            if tokens > remaining:
+                break
+            included.append(self._message(index))
+            remaining -= tokens
+        included.reverse()
+        return self._pinned() + included
+
+    def _fit_newest_turn(self, token_budget: int) -> List[Dict]:
+        """The newest turn with whatever is left of the pinned slots."""
+        if token_budget <= MESSAGE_OVERHEAD_TOKENS * 2:
+            raise ValueError(f"Token budget {token_budget} can't hold a system prompt and a turn")
+        newest = (self._start + self._size - 1) % self.capacity
+        # The system slot keeps at least its overhead, even if it ends up empty
+        content = truncate_to_tokens(self._contents[newest], token_budget - 2 * MESSAGE_OVERHEAD_TOKENS)
+        remaining = token_budget - count_tokens(content) - MESSAGE_OVERHEAD_TOKENS
+
+        system_content = truncate_to_tokens(self._system_message["content"],
+                                            remaining - MESSAGE_OVERHEAD_TOKENS, keep_end=False)
+        messages = [new_message(Role.SYSTEM, system_content)]
+        remaining -= count_tokens(system_content) + MESSAGE_OVERHEAD_TOKENS
+        if self._summary_message is not None and remaining > MESSAGE_OVERHEAD_TOKENS:
+            # The end of the summary covers the most recent part of the conversation
+            summary_content = truncate_to_tokens(self._summary_message["content"], remaining - MESSAGE_OVERHEAD_TOKENS)
+            messages.append(new_message(Role.SYSTEM, summary_content))
+        messages.append(new_message(ROLES_BY_CODE[self._roles[newest]], content))
+        return messages
+
+    def count_tokens(self) -> int:
+        """Tokens of the whole window, system slot and summary included."""
+        turn_tokens = sum(self._tokens[(self._start + i) % self.capacity] for i in range(self._size))
+        return self._system_tokens + self._summary_tokens + turn_tokens
+
+    def __len__(self) -> int:
+        return len(self._pinned()) + self._size
+
+    def __iter__(self) -> Iterator[Dict]:
+        yield from self._pinned()
+        for i in range(self._size):
+            yield self._message((self._start + i) % self.capacity)
+
+    def __getitem__(self, index: int) -> Dict:
+        # Indexed like the message list: the system slot and the summary come first
+        pinned = self._pinned()
+        length = len(pinned) + self._size
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("context window index out of range")
+        if index < len(pinned):
+            return pinned[index]
+        return self._message((self._start + index - len(pinned)) % self.capacity)
@@ -4,10 +4,10 @@ import os
 from dataclasses import dataclass, field
 from typing import List, Dict
 
-from src.agent.agent_service import AgentService, agent_service
-from src.agent.user_session import UserSession, UserSessionManager
+from src.agent.user_session import UserSessionManager
 from src.api.interface.llm_api_interface import LLMAPIInterfaceAsync
 from src.api.nvidia_playground_api_async import nvidia_playground_api_async
+from src.service.user_message_processor import UserMessageProcessor
 from src.utils.constants import new_message, Role
 from src.utils.logger import logger
 from src.utils.utils import remove_think_tag, get_current_time
@@ -21,7 +21,6 @@ class Event:
 
 class EventGenerator:
     llm_api: LLMAPIInterfaceAsync = nvidia_playground_api_async
-    agent_service: AgentService = agent_service
     system_prompt_str = '''You are an event generator for an AI girlfriend assistant. Your job is to simulate plausible life events, emotional states, or relational dynamics that could happen in the AI girlfriend's life. These events help the AI girlfriend decide whether to start a conversation.
         Generate events that:
         - Reflect emotional or social context (e.g., loneliness, stress, joy, anticipation).
@@ -44,8 +43,8 @@ class EventGenerator:
         # Bedtime
         if 0 <= hours <= 7:
             return
-        for user_session in UserSessionManager.get_idle_user_session(4, 0):
-            asyncio.create_task(EventGenerator.generate_event(user_session.user_id))
+        for user_id in await UserSessionManager.get_idle_user_ids(4, 0):
+            asyncio.create_task(EventGenerator.generate_event(user_id))
 
     @staticmethod
     async def generate_event(user_id: int, event_type: str="default") -> str:
@@ -54,9 +53,8 @@ class EventGenerator:
         event = remove_think_tag(event)
         event = f"This is your feeling and event. ${event}"
 
-        user_session = UserSessionManager.get_session(user_id)
-        # Send a message
-        await EventGenerator.agent_service.generate_reply(user_session, event)
+        # Send a message, in turn with the user's own
+        await UserMessageProcessor.submit_proactive(user_id, event)
         return event
 
 
@@ -0,0 +1,142 @@
+import random
+import re
+from typing import AsyncIterator, List, Optional
+
+from src.utils.utils import remove_think_tag
+
+THINK_START_TAG = "<think>"
+THINK_END_TAG = "</think>"
+IMAGE_START_TAG = "<image_prompt>"
+IMAGE_END_TAG = "</image_prompt>"
+
+# The sentence boundaries split_message_randomly splits on
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+(?=[A-Z])')
+
+
+class ReplyStream:
+    """
+    Turns the chunks of a streamed LLM reply into groups of 1 to 3 complete sentences, the
+    way split_message_randomly groups a finished reply, so each group can be sent as soon as
+    its last sentence is generated.
+
+    Like remove_think_tag, everything up to the first </think> is reasoning and never sent,
+    whether or not the reply opened it with <think>, so nothing is sent before that tag
+    arrived or the stream ended. Neither is an image prompt: the text from an unclosed
+    <image_prompt> tag on is held back until the tag is closed.
+
+    Each chunk is scanned once: the reply is consumed from where the last chunk left off, and
+    only the unfinished last sentence is searched for sentence boundaries again.
+    """
+
+    def __init__(self, chunks: AsyncIterator[str], min_group_size: int = 1, max_group_size: int = 3):
+        self.chunks = chunks
+        self.min_group_size = min_group_size
+        self.max_group_size = max_group_size
+        # Everything the model said so far, as generate_text_response would return it
+        self.raw_reply = ""
+        # Where the visible reply starts in raw_reply, once the end of the reasoning is known
+        self._visible_start: Optional[int] = None
+        # How far raw_reply has been searched for </think>, and consumed after it
+        self._think_scan = 0
+        self._scan = 0
+        self._in_image = False
+        self._after_image = False
+        self._started = False
+        # Complete sentences not sent yet, and the visible text of the sentence still going on
+        self._sentences: List[str] = []
+        self._tail = ""
+        self._boundary_scan = 0
+
+    @property
+    def reply(self) -> str:
+        return remove_think_tag(self.raw_reply)
+
+    async def sentence_groups(self) -> AsyncIterator[str]:
+        group_size = random.randint(self.min_group_size, self.max_group_size)
+        async for chunk in self.chunks:
+            self.raw_reply += chunk
+            self._consume(finished=False)
+            while len(self._sentences) >= group_size:
+                yield " ".join(self._sentences[:group_size]).strip()
+                del self._sentences[:group_size]
+                group_size = random.randint(self.min_group_size, self.max_group_size)
+        self._consume(finished=True)
+        rest = " ".join(self._sentences + [self._tail]).strip()
+        if rest.endswith('"'):
+            rest = rest[:-1]
+        if rest:
+            yield rest
+
+    def _consume(self, finished: bool):
+        """Move the visible text that arrived since the last call into sentences."""
+        if self._visible_start is None:
+            end = self.raw_reply.find(THINK_END_TAG, self._think_scan)
+            if end != -1:
+                self._visible_start = end + len(THINK_END_TAG)
+            elif finished:
+                # No reasoning after all
+                self._visible_start = 0
+            else:
+                # The tag may have partly arrived
+                self._think_scan = max(0, len(self.raw_reply) - len(THINK_END_TAG) + 1)
+                return
+            self._scan = self._visible_start
+
+        text = self.raw_reply
+        while True:
+            if self._in_image:
+                end = text.find(IMAGE_END_TAG, self._scan)
+                if end == -1:
+                    # Hold back the unfinished image prompt
+                    self._scan = max(self._scan, len(text) - len(IMAGE_END_TAG) + 1)
+                    break
+                self._scan = end + len(IMAGE_END_TAG)
+                self._in_image = False
+                self._tail = self._tail.rstrip()
+                self._after_image = True
+                continue
+            start = text.find(IMAGE_START_TAG, self._scan)
+            if start != -1:
+                self._append(text[self._scan:start])
+                self._scan = start + len(IMAGE_START_TAG)
+                self._in_image = True
+                continue
+            stop = len(text)
+            if not finished:
+                # A tag that has only partly arrived
+                for i in range(len(IMAGE_START_TAG) - 1, 0, -1):
+                    if text.endswith(IMAGE_START_TAG[:i]):
+                        stop -= i
+                        break
+            self._append(text[self._scan:stop])
+            self._scan = max(self._scan, stop)
+            break
+        self._split_sentences()
+
+    def _append(self, text: str):
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return
+            if text.startswith('"'):
+                text = text[1:]
+            self._started = True
+        if self._after_image:
+            # Text around a removed image prompt is joined by a single space
+            text = text.lstrip()
+            if not text:
+                return
+            if self._tail:
+                text = " " + text
+            self._after_image = False
+        self._tail += text
+
+    def _split_sentences(self):
+        # A boundary needs the capital letter after it, so one found is final; one that is still
+        # going on can only start in the whitespace at the end of the tail
+        last_end = 0
+        for match in SENTENCE_BOUNDARY.finditer(self._tail, self._boundary_scan):
+            self._sentences.append(self._tail[last_end:match.start()])
+            last_end = match.end()
+        self._tail = self._tail[last_end:]
+        self._boundary_scan = len(self._tail.rstrip())
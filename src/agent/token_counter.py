@@ -0,0 +1,38 @@
+from src.utils.logger import logger
+
+# tiktoken is optional. Its cl100k_base encoding is not the tokenizer of every model we call,
+# but close enough to budget prompts; without it we fall back to ~4 characters per token.
+_encoding = None
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception as e:
+    logger.info(f"tiktoken unavailable, estimating token counts from text length: {e}")
+
+# Role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def count_message_tokens(message: dict) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep_end: bool = True) -> str:
+    """
+    By default keep the end of text, which is the part a reply is most likely to refer to;
+    with keep_end=False keep its beginning, e.g. for a system prompt.
+    """
+    if max_tokens <= 0:
+        return ""
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return _encoding.decode(tokens[-max_tokens:] if keep_end else tokens[:max_tokens])
+    return text[-max_tokens * 4:] if keep_end else text[:max_tokens * 4]
@@ -1,16 +1,32 @@
+import asyncio
+import json
+import sys
 import time
+import zlib
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Set, Optional, Callable
 
 import pytz
+from sortedcontainers import SortedList
 
+from src.agent.context_window import ContextWindow, Turn
 from src.agent.memory import memory
 from src.persona.persona_manager import get_persona_prompt
+from src.redis.redis_client import async_redis_binary_client
 from src.utils.config import config
-from src.utils.constants import new_message, Role
+from src.utils.constants import new_message, Role, ROLE_CODES, ROLES_BY_CODE
+from src.utils.logger import logger
+
+SUMMARY_PREFIX = "Summary of your earlier conversation with the user:\n"
 
 
 class UserSession:
+    # No per-instance __dict__: with many resident sessions it adds up
+    __slots__ = ("user_id", "_user_full_name", "_reply_with_voice", "_enable_push", "_enable_image",
+                 "_enable_long_term_memory", "_last_active", "_max_context_length", "persona_code",
+                 "system_message", "context_window", "pending_summary_turns", "context_epoch", "_resident_bytes")
+
     def __init__(self, user_id: int, user_full_name: str = ""):
         self.user_id: int = user_id
         self._user_full_name: str = user_full_name
@@ -21,16 +37,74 @@ class UserSession:
         self._last_active: float = -1
         self._max_context_length: int = config.user_session_settings["max_context_length"]
         self.persona_code = config.default_persona_code
-        self.persona_prompt = ""
         # Order matters
         self.system_message: Dict = new_message(Role.SYSTEM, "")
-        self.context: List[Dict] = [self.system_message]
+        # max_context_length counts the system prompt too
+        self.context_window = ContextWindow(self._max_context_length - 1, self.system_message)
+        # Turns pushed out of the window that the compactor has not folded into the summary yet
+        self.pending_summary_turns: List[Turn] = []
+        # Bumped whenever the context is cleared, so a summary of the old context is discarded
+        self.context_epoch: int = 0
+        self._resident_bytes: Optional[int] = None
         self.set_persona(self.persona_code)
 
+    def _mark_dirty(self):
+        self._resident_bytes = None
+        UserSessionManager.mark_dirty(self)
+
+    def resident_bytes(self) -> int:
+        """Approximate memory held by the session: the object, its context and the persona prompt."""
+        if self._resident_bytes is None:
+            window = self.context_window
+            size = sys.getsizeof(self) + sys.getsizeof(window)
+            size += sys.getsizeof(window._roles) + sys.getsizeof(window._contents) + sys.getsizeof(window._tokens)
+            for message in (self.system_message, window.system_message, window.summary_message):
+                if message is not None:
+                    size += sys.getsizeof(message) + sys.getsizeof(message["content"])
+            size += sum(sys.getsizeof(content) for content in window.contents())
+            size += sys.getsizeof(self.pending_summary_turns)
+            size += sum(sys.getsizeof(turn) + sys.getsizeof(turn[1]) for turn in self.pending_summary_turns)
+            self._resident_bytes = size
+        return self._resident_bytes
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialise the session for Redis. The system prompt is not stored: it is rebuilt from
+        the persona code and the user's name when the session is loaded.
+        """
+        state = {
+            "n": self._user_full_name,
+            "p": self.persona_code,
+            "f": [self._reply_with_voice, self._enable_push, self._enable_image, self._enable_long_term_memory],
+            "a": self._last_active,
+            "c": [[ROLE_CODES[role], content] for role, content in self.context_window.turns()],
+            "s": self.summary,
+            "e": [[ROLE_CODES[role], content] for role, content in self.pending_summary_turns],
+        }
+        return zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+
+    @classmethod
+    def from_bytes(cls, user_id: int, data: bytes) -> "UserSession":
+        state = json.loads(zlib.decompress(data))
+        session = cls(user_id, state["n"])
+        try:
+            session.set_persona(state["p"])
+        except ValueError:
+            logger.info(f"Persona {state['p']} of user {user_id} no longer exists, using the default persona")
+        (session._reply_with_voice, session._enable_push,
+         session._enable_image, session._enable_long_term_memory) = state["f"]
+        session._last_active = state["a"]
+        for code, content in state["c"]:
+            session.context_window.append(ROLES_BY_CODE[code], content)
+        if state.get("s"):
+            session.set_summary(state["s"])
+        session.pending_summary_turns = [(ROLES_BY_CODE[code], content) for code, content in state.get("e", [])]
+        return session
+
     def to_string(self) -> str:
         houston_tz = pytz.timezone('America/Chicago')
 
-        attributes = {k: v for k, v in self.__dict__.items() if k != "context"}
+        attributes = {k: getattr(self, k) for k in self.__slots__ if k not in ("context_window", "pending_summary_turns")}
 
         if "_last_active" in attributes and attributes["_last_active"] > 0:
             attributes["_last_active"] = datetime.fromtimestamp(attributes["_last_active"], houston_tz).strftime(
@@ -38,27 +112,50 @@ class UserSession:
 
         return "\n".join(f"{key}: {value}" for key, value in attributes.items())
 
+    def _add_turn(self, role: Role, content: str):
+        evicted = self.context_window.append(role, content)
+        if evicted is not None:
+            self._queue_for_summary([evicted])
+
+    def _queue_for_summary(self, turns: List[Turn]):
+        self.pending_summary_turns.extend(turns)
+        max_pending = config.user_session_settings["summary_batch_turns"] * 4
+        if len(self.pending_summary_turns) > max_pending:
+            # The compactor is falling behind; forget the oldest turns rather than growing without bound
+            del self.pending_summary_turns[:len(self.pending_summary_turns) - max_pending]
+
+    def fit_context(self, token_budget: int):
+        """
+        Move the oldest turns that would not fit token_budget out of the window and queue them
+        for the summary, instead of leaving them in the window where the LLM never sees them.
+        """
+        evicted = self.context_window.evict_to_budget(token_budget)
+        if evicted:
+            self._queue_for_summary(evicted)
+            self._mark_dirty()
+
     def add_user_context(self, user_input: str):
-        self.context.append(new_message(Role.USER, user_input))
+        self._add_turn(Role.USER, user_input)
         if self._enable_long_term_memory:
             memory.add(new_message(Role.USER, user_input), user_id=self.user_id)
+        previous_last_active = self._last_active
         self._last_active = time.time()
-        if len(self.context) > self._max_context_length:
-            self.context.pop(1) # context[0] is system prompt
+        UserSessionManager.update_last_active(self, previous_last_active)
+        self._mark_dirty()
 
     def add_bot_context(self, bot_input):
-        self.context.append(new_message(Role.ASSISTANT, bot_input))
+        self._add_turn(Role.ASSISTANT, bot_input)
         if self._enable_long_term_memory:
             memory.add(new_message(Role.ASSISTANT, bot_input), user_id=self.user_id)
-        if len(self.context) > self._max_context_length:
-            self.context.pop(1)
+        self._mark_dirty()
 
     def recall_memory(self, query: str, limit: int = 3) -> str:
         if not self._enable_long_term_memory:
             return ""
         relevant_memories = memory.search(query=query, user_id=self.user_id, limit=limit)
         memories_str = "\nYour memories:\n" + "\n".join(f"- {entry['memory']}" for entry in relevant_memories["results"])
-        self.context[0] = new_message(Role.SYSTEM, self.system_message["content"] + memories_str)
+        self.context_window.system_message = new_message(Role.SYSTEM, self.system_message["content"] + memories_str)
+        self._resident_bytes = None
         return memories_str
 
 
@@ -70,12 +167,29 @@ class UserSession:
         self.persona_code = persona_code
         self.clear_context()
 
+    @property
+    def context(self) -> List[Dict]:
+        """Message list for the LLM, system prompt first."""
+        return self.context_window.to_messages()
+
     def get_context(self):
         return self.context
 
     def clear_context(self):
-        self.context.clear()
-        self.context.append(self.system_message)
+        self.context_window.clear()
+        self.context_window.system_message = self.system_message
+        self.pending_summary_turns = []
+        self.context_epoch += 1
+        self._mark_dirty()
+
+    @property
+    def summary(self) -> str:
+        summary_message = self.context_window.summary_message
+        return summary_message["content"][len(SUMMARY_PREFIX):] if summary_message is not None else ""
+
+    def set_summary(self, summary: str):
+        self.context_window.summary_message = new_message(Role.SYSTEM, SUMMARY_PREFIX + summary)
+        self._mark_dirty()
 
     def is_idle(self, hour: int, minute: int = 0) -> bool:
         idle_time = time.time() - self._last_active
@@ -100,6 +214,7 @@ class UserSession:
     @enable_long_term_memory.setter
     def enable_long_term_memory(self, value: bool):
         self._enable_long_term_memory = value
+        self._mark_dirty()
 
     @property
     def reply_with_voice(self):
@@ -108,6 +223,7 @@ class UserSession:
     @reply_with_voice.setter
     def reply_with_voice(self, value):
         self._reply_with_voice = value
+        self._mark_dirty()
 
     @property
     def enable_push(self):
@@ -116,6 +232,7 @@ class UserSession:
     @enable_push.setter
     def enable_push(self, value):
         self._enable_push = value
+        self._mark_dirty()
 
     @property
     def enable_image(self):
@@ -124,6 +241,7 @@ class UserSession:
     @enable_image.setter
     def enable_image(self, value):
         self._enable_image = value
+        self._mark_dirty()
 
     @property
     def last_active(self):
@@ -131,25 +249,234 @@ class UserSession:
 
 
 class UserSessionManager:
-    sessions: Dict[int, UserSession] = {}
+    """
+    Sessions are persisted to Redis write-behind: changes only mark a session dirty, and a
+    background task writes all dirty sessions every few seconds in one pipeline.
+
+    Only a bounded set of sessions stays in memory. After each flush the least recently used
+    clean sessions are evicted until both max_resident_sessions and max_resident_mb hold,
+    along with sessions idle for longer than evict_idle_minutes (0 keeps idle sessions).
+    get_session() loads a session that is not resident from Redis, so an evicted session, or
+    one last served by another bot instance, comes back with its context.
+    """
+    sessions: OrderedDict[int, UserSession] = OrderedDict()
+    # (last_active, user_id) of every resident session, so idle users are found with a range query
+    _idle_index: SortedList = SortedList()
+    # Called with the user id of every evicted session
+    eviction_listeners: List[Callable[[int], None]] = []
+    dirty_sessions: Dict[int, UserSession] = {}
+    redis_client = async_redis_binary_client
+    # user_id -> last activity of every persisted session, resident or not
+    _last_active_key = "user_session:last_active"
+    _loading: Dict[int, asyncio.Future] = {}
+    _flusher_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _get_key(user_id: int) -> str:
+        return f"user_session:{user_id}"
+
+    @staticmethod
+    def _add_resident(session: UserSession):
+        UserSessionManager.sessions[session.user_id] = session
+        UserSessionManager._idle_index.add((session.last_active, session.user_id))
+
+    @staticmethod
+    def _remove_resident(user_id: int):
+        session = UserSessionManager.sessions.pop(user_id)
+        UserSessionManager._idle_index.discard((session.last_active, user_id))
+        for listener in UserSessionManager.eviction_listeners:
+            listener(user_id)
+
+    @staticmethod
+    def update_last_active(session: UserSession, previous_last_active: float):
+        if UserSessionManager.sessions.get(session.user_id) is not session:
+            return
+        UserSessionManager._idle_index.discard((previous_last_active, session.user_id))
+        UserSessionManager._idle_index.add((session.last_active, session.user_id))
+
+    @staticmethod
+    def mark_dirty(session: UserSession):
+        UserSessionManager.dirty_sessions[session.user_id] = session
+
+    @staticmethod
+    async def get_session(user_id: int) -> UserSession:
+        session = UserSessionManager.sessions.get(user_id)
+        if session is not None:
+            UserSessionManager.sessions.move_to_end(user_id)
+            return session
+        # Concurrent first accesses of one user share a single load
+        loading = UserSessionManager._loading.get(user_id)
+        if loading is None:
+            loading = asyncio.ensure_future(UserSessionManager._load(user_id))
+            UserSessionManager._loading[user_id] = loading
+            loading.add_done_callback(lambda _: UserSessionManager._loading.pop(user_id, None))
+        return await asyncio.shield(loading)
+
+    @staticmethod
+    async def _load(user_id: int) -> UserSession:
+        # Evicted before its last changes were flushed
+        session = UserSessionManager.dirty_sessions.get(user_id)
+        if session is None:
+            try:
+                data = await UserSessionManager.redis_client.get(UserSessionManager._get_key(user_id))
+            except Exception as e:
+                # A fresh session in its place would be flushed over the stored one
+                logger.error(f"Error loading session of user {user_id}: {e}")
+                raise
+            session = UserSessionManager.sessions.get(user_id)
+            if session is not None:
+                return session
+            session = None if data is None else UserSessionManager._decode(user_id, data)
+            if session is None:
+                session = UserSession(user_id)
+            else:
+                UserSessionManager.dirty_sessions.pop(user_id, None)
+        UserSessionManager._add_resident(session)
+        return session
+
+    @staticmethod
+    def _decode(user_id: int, data: bytes) -> Optional[UserSession]:
+        """Decode a stored session, or None if it is corrupt or from an incompatible version."""
+        try:
+            return UserSession.from_bytes(user_id, data)
+        except Exception as e:
+            # Replaced by a fresh session, which overwrites it on the next flush
+            logger.error(f"Stored session of user {user_id} can't be decoded, starting a fresh one: {e}")
+            return None
+
+    @staticmethod
+    async def preload(batch_size: int = 100) -> int:
+        """Load the most recently active persisted sessions in the background, up to the resident capacity."""
+        capacity = config.user_session_settings["max_resident_sessions"]
+        user_ids = [int(user_id) for user_id in
+                    await UserSessionManager.redis_client.zrevrange(UserSessionManager._last_active_key, 0, capacity - 1)]
+        loaded = 0
+        # Oldest first, so the most recently active users end up last in LRU order
+        user_ids.reverse()
+        for i in range(0, len(user_ids), batch_size):
+            batch = [user_id for user_id in user_ids[i:i + batch_size] if user_id not in UserSessionManager.sessions]
+            if not batch:
+                continue
+            values = await UserSessionManager.redis_client.mget([UserSessionManager._get_key(user_id) for user_id in batch])
+            for user_id, data in zip(batch, values):
+                if data is None or user_id in UserSessionManager.sessions:
+                    continue
+                session = UserSessionManager._decode(user_id, data)
+                if session is None:
+                    continue
+                UserSessionManager._add_resident(session)
+                UserSessionManager.dirty_sessions.pop(user_id, None)
+                loaded += 1
+        logger.info(f"Preloaded {loaded} user sessions")
+        return loaded
+
+    @staticmethod
+    async def get_idle_user_ids(hours: int, minutes: int = 0, limit: Optional[int] = None) -> List[int]:
+        """
+        Users idle for the given time, including those whose sessions are not resident, the most
+        recently active first. At most `limit` of them, by default max_idle_users.
+        """
+        if limit is None:
+            limit = config.user_session_settings["max_idle_users"]
+        deadline = time.time() - 3600 * hours - 60 * minutes
+        user_ids = await UserSessionManager.redis_client.zrevrangebyscore(UserSessionManager._last_active_key,
+                                                                          deadline, "-inf", start=0, num=limit)
+        return [int(user_id) for user_id in user_ids]
+
+    @staticmethod
+    async def flush() -> int:
+        """Write all dirty sessions to Redis in one pipeline."""
+        if not UserSessionManager.dirty_sessions:
+            return 0
+        dirty_sessions = UserSessionManager.dirty_sessions
+        UserSessionManager.dirty_sessions = {}
+        ttl = config.user_session_settings["session_ttl_days"] * 24 * 3600
+        try:
+            async with UserSessionManager.redis_client.pipeline(transaction=False) as pipe:
+                for user_id, session in dirty_sessions.items():
+                    pipe.set(UserSessionManager._get_key(user_id), session.to_bytes(), ex=ttl)
+                    pipe.zadd(UserSessionManager._last_active_key, {user_id: session.last_active})
+                # Users inactive for longer than the session TTL have no stored session left to load
+                pipe.zremrangebyscore(UserSessionManager._last_active_key, "-inf", time.time() - ttl)
+                await pipe.execute()
+        except Exception:
+            # Sessions changed again since the snapshot are newer than what failed to be written
+            for user_id, session in dirty_sessions.items():
+                UserSessionManager.dirty_sessions.setdefault(user_id, session)
+            raise
+        return len(dirty_sessions)
+
+    @staticmethod
+    def evict() -> int:
+        max_sessions = config.user_session_settings["max_resident_sessions"]
+        max_bytes = config.user_session_settings["max_resident_mb"] * 1024 * 1024
+        idle_seconds = config.user_session_settings["evict_idle_minutes"] * 60
+        sessions = UserSessionManager.sessions
+        resident_bytes = sum(session.resident_bytes() for session in sessions.values())
+        now = time.time()
+        evicted = 0
+        # Least recently used first
+        for user_id in list(sessions.keys()):
+            session = sessions[user_id]
+            over_capacity = len(sessions) > max_sessions or resident_bytes > max_bytes
+            is_idle = idle_seconds > 0 and now - session.last_active > idle_seconds
+            if not over_capacity and not is_idle:
+                continue
+            if user_id in UserSessionManager.dirty_sessions:
+                # Evicted after the next flush
+                continue
+            resident_bytes -= session.resident_bytes()
+            UserSessionManager._remove_resident(user_id)
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} user sessions, {len(sessions)} resident ({resident_bytes} bytes)")
+        return evicted
+
+    @staticmethod
+    def get_memory_stats() -> Dict[str, int]:
+        sizes = [session.resident_bytes() for session in UserSessionManager.sessions.values()]
+        return {
+            "resident_sessions": len(sizes),
+            "resident_bytes": sum(sizes),
+            "bytes_per_session": sum(sizes) // len(sizes) if sizes else 0,
+            "max_session_bytes": max(sizes, default=0),
+        }
+
+    @staticmethod
+    async def _flush_periodically(interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await UserSessionManager.flush()
+                UserSessionManager.evict()
+            except Exception as e:
+                logger.error(f"Error flushing user sessions: {e}")
+
+    @staticmethod
+    def start_flusher():
+        interval = config.user_session_settings["flush_interval_seconds"]
+        UserSessionManager._flusher_task = asyncio.create_task(UserSessionManager._flush_periodically(interval))
 
     @staticmethod
-    def get_session(user_id: int) -> UserSession:
-        if user_id not in UserSessionManager.sessions:
-            UserSessionManager.sessions[user_id] = UserSession(user_id)
-        return UserSessionManager.sessions[user_id]
+    async def stop_flusher():
+        if UserSessionManager._flusher_task is not None:
+            UserSessionManager._flusher_task.cancel()
+            await asyncio.gather(UserSessionManager._flusher_task, return_exceptions=True)
+            UserSessionManager._flusher_task = None
+        await UserSessionManager.flush()
+        logger.info("User sessions flushed")
 
     @staticmethod
     def get_all_sessions() -> List[UserSession]:
+        """Resident sessions only."""
         return list(UserSessionManager.sessions.values())
 
     @staticmethod
     def get_idle_user_session(hours: int, minutes: int = 0) -> List[UserSession]:
-        idle_sessions: List[UserSession] = []
-        for user_session in UserSessionManager.sessions.values():
-            if time.time() - user_session.last_active > 3600 * hours + 60 * minutes:
-                idle_sessions.append(user_session)
-        return idle_sessions
+        """Resident sessions idle for longer than the given time, longest idle first."""
+        deadline = time.time() - 3600 * hours - 60 * minutes
+        idle_entries = UserSessionManager._idle_index.irange(maximum=(deadline,), inclusive=(True, False))
+        return [UserSessionManager.sessions[user_id] for _, user_id in idle_entries]
 
     @staticmethod
     def get_all_user_id() -> List[int]:
@@ -61,7 +61,12 @@ class AwsApi(TTSAPIInterface):
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.DEVNULL
         )
-        stdout, _ = await process.communicate(input=audio_data)
+        try:
+            stdout, _ = await process.communicate(input=audio_data)
+        except asyncio.CancelledError:
+            # The reply was superseded; don't leave ffmpeg running
+            process.kill()
+            raise
         return io.BytesIO(stdout)
 
     def remove_emojis(self, text: str) -> str:
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import AsyncIterator
 
 class LLMAPIInterfaceAsync(ABC):
     @property
@@ -6,6 +7,15 @@ class LLMAPIInterfaceAsync(ABC):
     def api_name(self) -> str:
         pass
 
+    @property
+    def model_name(self) -> str:
+        """Name of the model behind generate_text_response, used to look up its context token budget."""
+        return ""
+
     @abstractmethod
     async def generate_text_response(self, context: list[dict]) -> str:
         pass
+
+    async def generate_text_response_stream(self, context: list[dict]) -> AsyncIterator[str]:
+        """The reply in chunks as it is generated. APIs that can't stream yield it in one piece."""
+        yield await self.generate_text_response(context)
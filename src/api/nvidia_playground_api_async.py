@@ -1,5 +1,7 @@
 import httpx
 import asyncio
+from typing import AsyncIterator
+
 from openai import AsyncOpenAI
 
 from src.api.interface.image2text_api_interface import Image2TextAPIInterfaceAsync
@@ -14,6 +16,10 @@ class NvidiaPlaygroundAPIAsync(LLMAPIInterfaceAsync, Image2TextAPIInterfaceAsync
     def api_name(self):
         return "Nvidia Playground API"
 
+    @property
+    def model_name(self) -> str:
+        return self._text_model
+
     def __init__(self, api_url: str, llm_name: str, image2text_api_url: str, text2image_api_url: str):
         self._text_model = llm_name
         self._api_url = api_url
@@ -40,6 +46,23 @@ class NvidiaPlaygroundAPIAsync(LLMAPIInterfaceAsync, Image2TextAPIInterfaceAsync
         except Exception:
             return f"Bad response from {self.api_name}"
 
+    async def generate_text_response_stream(self, context: list[dict]) -> AsyncIterator[str]:
+        stream = await self.client.chat.completions.create(
+            model=self._text_model,
+            messages=context,
+            temperature=0.6,
+            top_p=0.7,
+            max_tokens=4096,
+            stream=True
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Stops the generation if the reply is cancelled half way
+            await stream.close()
+
     async def describe_image(self, context: list[dict], image_b64: str) -> str:
         async with httpx.AsyncClient() as client:
             headers = {"Authorization": f"Bearer {self._api_key}", "Accept": "application/json"}
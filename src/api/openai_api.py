@@ -16,6 +16,10 @@ class OpenAIAPI(Speech2TextAPIInterfaceAsync, LLMAPIInterfaceAsync):
     def api_name(self) -> str:
         return "OpenAI API"
 
+    @property
+    def model_name(self) -> str:
+        return "gpt-3.5-turbo"
+
     async def speech_to_text(self, speech: io.BytesIO) -> str:
         transcription = await self.client.audio.transcriptions.create(
             model="whisper-1",
@@ -28,7 +32,7 @@ class OpenAIAPI(Speech2TextAPIInterfaceAsync, LLMAPIInterfaceAsync):
     async def generate_text_response(self, context: list[dict]) -> str:
         try:
             response = await self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
+                model=self.model_name,
                 messages=context,
                 temperature=0.7,
                 max_tokens=1000
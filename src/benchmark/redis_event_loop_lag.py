@@ -0,0 +1,108 @@
+"""Measures event-loop lag while N simulated users push and pop chat messages through Redis.
+
+"before" drives the queues with the synchronous module-level redis client, the way
+ChatMessageStore used to. "after" goes through the asyncio ChatMessageStore and its
+bounded connection pool.
+
+Usage:
+    python -m src.benchmark.redis_event_loop_lag --users 200 --rounds 20
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from src.data.Message import Message, MessageType, ChatMessageStore
+from src.redis.redis_client import redis_client, async_redis_client
+
+BENCH_USER_ID_OFFSET = 10_000_000
+
+# The list-backed store whatever the delivery mode, since the stream store has no per-user queues to drain
+chat_message_store = ChatMessageStore()
+
+
+class LagMonitor:
+    """Wakes up every `interval` seconds and records how late the wake-up was."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._running = False
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._running = True
+        while self._running:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def stop(self):
+        self._running = False
+
+
+def _percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _bench_message(user_id: int) -> Message:
+    return Message(MessageType.TEXT, "benchmark " * 20, "benchmark", user_id)
+
+
+async def sync_user(user_id: int, rounds: int):
+    queue_key = f"chat_message_store:{user_id}"
+    for _ in range(rounds):
+        redis_client.rpush(queue_key, json.dumps(_bench_message(user_id).to_dict()))
+        while redis_client.llen(queue_key) > 0:
+            Message.from_dict(json.loads(redis_client.lpop(queue_key)))
+        await asyncio.sleep(0)
+
+
+async def async_user(user_id: int, rounds: int):
+    for _ in range(rounds):
+        await chat_message_store.enqueue(user_id, _bench_message(user_id))
+        while await chat_message_store.get_length(user_id) > 0:
+            await chat_message_store.dequeue(user_id)
+        await asyncio.sleep(0)
+
+
+async def run_scenario(name: str, user_coroutine, users: int, rounds: int) -> dict:
+    monitor = LagMonitor()
+    monitor_task = asyncio.create_task(monitor.run())
+    start = time.perf_counter()
+    await asyncio.gather(*(user_coroutine(BENCH_USER_ID_OFFSET + i, rounds) for i in range(users)))
+    duration = time.perf_counter() - start
+    monitor.stop()
+    await monitor_task
+    lag_ms = [sample * 1000 for sample in monitor.samples]
+    return {
+        "scenario": name,
+        "duration_s": round(duration, 3),
+        "lag_p50_ms": round(_percentile(lag_ms, 50), 2),
+        "lag_p99_ms": round(_percentile(lag_ms, 99), 2),
+        "lag_max_ms": round(max(lag_ms, default=0.0), 2),
+        "lag_mean_ms": round(statistics.fmean(lag_ms), 2) if lag_ms else 0.0,
+    }
+
+
+async def main(users: int, rounds: int):
+    results = [
+        await run_scenario("before (sync redis)", sync_user, users, rounds),
+        await run_scenario("after (redis.asyncio pool)", async_user, users, rounds),
+    ]
+    await async_redis_client.delete(*(f"chat_message_store:{BENCH_USER_ID_OFFSET + i}" for i in range(users)))
+    for result in results:
+        print(result)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="Number of concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=20, help="Messages each user enqueues and drains")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.rounds))
@@ -0,0 +1,122 @@
+"""Measures the memory held per resident user session and per Message.
+
+"before" rebuilds the old representations: a session object with a per-instance __dict__
+and its context as a list of {"role", "content"} dicts, and Message as a dataclass without
+slots. "after" uses the slotted UserSession with its compact ContextWindow and the slotted
+Message. Both hold the same strings, so the difference is the bookkeeping around them.
+
+Usage:
+    python -m src.benchmark.session_memory --sessions 2000 --turns 99
+"""
+import argparse
+import datetime
+import gc
+import io
+import mmap
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+
+from src.agent.user_session import UserSession, UserSessionManager
+from src.data.Message import Message, MessageType
+from src.persona.persona_manager import get_persona_prompt
+from src.utils.config import config
+from src.utils.constants import new_message, Role
+
+BENCH_USER_ID_OFFSET = 10_000_000
+
+
+class LegacySession:
+    """The attributes UserSession used to carry in its __dict__."""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._user_full_name = ""
+        self._reply_with_voice = True
+        self._enable_push = False
+        self._enable_image = True
+        self._enable_long_term_memory = False
+        self._last_active = -1.0
+        self._max_context_length = 100
+        self.persona_code = config.default_persona_code
+        self.persona_prompt = ""
+        self.system_message: Dict = new_message(Role.SYSTEM, get_persona_prompt(self.persona_code, ""))
+        self.context: List[Dict] = [self.system_message]
+
+
+@dataclass
+class LegacyMessage:
+    message_type: MessageType
+    content: Union[str, io.BytesIO, mmap.mmap]
+    prompt: str
+    user_id: int
+    timestamp: datetime.datetime = field(default_factory=datetime.datetime.now)
+    digest: Optional[str] = None
+
+
+def _turn_text(user_id: int, turn: int) -> str:
+    # Distinct strings, so that none are shared between sessions
+    return f"user {user_id} turn {turn}: " + "lorem ipsum " * 8
+
+
+def _measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    objects = build()
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return after - before
+
+
+def build_legacy_sessions(sessions: int, turns: int) -> list:
+    result = []
+    for i in range(sessions):
+        user_id = BENCH_USER_ID_OFFSET + i
+        session = LegacySession(user_id)
+        for turn in range(turns):
+            role = Role.USER if turn % 2 == 0 else Role.ASSISTANT
+            session.context.append(new_message(role, _turn_text(user_id, turn)))
+        result.append(session)
+    return result
+
+
+def build_sessions(sessions: int, turns: int) -> list:
+    result = []
+    for i in range(sessions):
+        user_id = BENCH_USER_ID_OFFSET + i
+        session = UserSession(user_id)
+        for turn in range(turns):
+            role = Role.USER if turn % 2 == 0 else Role.ASSISTANT
+            session.context_window.append(role, _turn_text(user_id, turn))
+        result.append(session)
+    # Not part of the session's own footprint
+    UserSessionManager.dirty_sessions.clear()
+    return result
+
+
+def build_messages(message_class, count: int) -> list:
+    return [message_class(MessageType.TEXT, _turn_text(BENCH_USER_ID_OFFSET + i, 0), "benchmark", BENCH_USER_ID_OFFSET + i)
+            for i in range(count)]
+
+
+def main(sessions: int, turns: int, messages: int):
+    results = {
+        "bytes_per_session (before)": _measure(lambda: build_legacy_sessions(sessions, turns)) // sessions,
+        "bytes_per_session (after)": _measure(lambda: build_sessions(sessions, turns)) // sessions,
+        "bytes_per_message (before)": _measure(lambda: build_messages(LegacyMessage, messages)) // messages,
+        "bytes_per_message (after)": _measure(lambda: build_messages(Message, messages)) // messages,
+    }
+    for name, value in results.items():
+        print(f"{name}: {value}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=2000, help="Number of resident sessions to build")
+    parser.add_argument("--turns", type=int, default=99, help="Conversation turns per session")
+    parser.add_argument("--messages", type=int, default=100000, help="Number of Message objects to build")
+    args = parser.parse_args()
+    main(args.sessions, args.turns, args.messages)
@@ -1,12 +1,22 @@
 import datetime
 import io
+import mmap
+import os
+import socket
+import time
 import json
 import base64
+import struct
 from enum import Enum
 from dataclasses import dataclass, field
-from typing import Union, Optional, Dict
+from typing import Union, Optional, Dict, List, Iterable, Tuple
 
-from src.redis.redis_client import redis_client
+from redis.exceptions import ResponseError
+
+from src.data.blob_store import blob_store
+from src.redis.redis_client import async_redis_binary_client
+from src.utils.config import config
+from src.utils.logger import logger
 
 
 class MessageType(Enum):
@@ -18,13 +28,17 @@ class MessageType(Enum):
     BAD_MESSAGE = "bad_message"
 
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     message_type: MessageType
-    content: Union[str, io.BytesIO]
+    content: Union[str, io.BytesIO, mmap.mmap]
     prompt: str
     user_id: int
     timestamp: datetime.datetime = field(default_factory=datetime.datetime.now)
+    # Set once the media content lives in the blob store; the content is then a read-only mapping
+    digest: Optional[str] = None
+    # False for the later parts of a reply that is sent in several messages, which is charged once
+    billable: bool = True
 
     def to_dict(self) -> Dict:
         result = {
@@ -56,30 +70,330 @@ class Message:
 
         return cls(message_type=message_type, content=content, prompt=prompt, user_id=user_id, timestamp=data["timestamp"])
 
+    def to_bytes(self) -> bytes:
+        """
+        Binary envelope: a 4-byte header length, a small JSON header, then the raw content.
+        Media is copied once, straight from the BytesIO buffer into the envelope, unless it
+        has been moved to the blob store, in which case only its digest is carried.
+        """
+        header = {
+            "message_type": self.message_type.value,
+            "prompt": self.prompt,
+            "timestamp": self.timestamp.isoformat(),
+            "user_id": self.user_id,
+            "content_type": "str" if isinstance(self.content, str) else "bytes",
+        }
+        if self.digest is not None:
+            header["content_type"] = "blob"
+            header["digest"] = self.digest
+        if not self.billable:
+            header["billable"] = False
+        header_bytes = json.dumps(header).encode('utf-8')
+        prefix = struct.pack(">I", len(header_bytes))
+        if self.digest is not None:
+            return prefix + header_bytes
+        if isinstance(self.content, str):
+            return b"".join((prefix, header_bytes, self.content.encode('utf-8')))
+        with self.content.getbuffer() as body:
+            return b"".join((prefix, header_bytes, body))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Message':
+        view = memoryview(data)
+        (header_length,) = struct.unpack_from(">I", view)
+        body_start = 4 + header_length
+        header = json.loads(bytes(view[4:body_start]))
+        digest = header.get("digest")
+        if header["content_type"] == "str":
+            content = str(view[body_start:], 'utf-8')
+        elif header["content_type"] == "blob":
+            content = blob_store.open(digest)
+        else:
+            content = io.BytesIO(view[body_start:])
+        return cls(message_type=MessageType(header["message_type"]),
+                   content=content,
+                   prompt=header["prompt"],
+                   user_id=header["user_id"],
+                   timestamp=datetime.datetime.fromisoformat(header["timestamp"]),
+                   digest=digest,
+                   billable=header.get("billable", True))
+
+
+async def offload_media(message: Message) -> None:
+    """Move voice or image content into the blob store, taking one reference for the queue entry."""
+    if message.digest is not None or not isinstance(message.content, io.BytesIO):
+        return
+    with message.content.getbuffer() as data:
+        message.digest = await blob_store.put(data)
+
+
+def encode_message(message: Message) -> bytes:
+    return message.to_bytes()
+
+
+def decode_message(data: bytes) -> Message:
+    # Entries queued before the binary envelope are base64-in-JSON documents
+    if data[:1] == b"{":
+        return Message.from_dict(json.loads(data))
+    return Message.from_bytes(data)
+
+
+# Takes up to ARGV[1] messages from the head of the queue KEYS[1] in one atomic step.
+# Once the queue is empty, user ARGV[2] is removed from the pending index KEYS[2].
+BATCH_POP_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+end
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+return items
+"""
+
 
 class ChatMessageStore:
     def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0, password: Optional[str] = None):
-        self.redis_client = redis_client
+        self.redis_client = async_redis_binary_client
+        self._batch_pop = self.redis_client.register_script(BATCH_POP_SCRIPT)
+        # Sorted set of users with a non-empty queue, scored by when their oldest pending message arrived
+        self._pending_key = "chat_message_store:pending"
 
     def _get_queue_key(self, user_id: int) -> str:
         return f"chat_message_store:{user_id}"
 
-    def enqueue(self, user_id: int, message: Message) -> None:
+    async def enqueue(self, user_id: int, message: Message) -> None:
         queue_key = self._get_queue_key(user_id)
-        message_data = message.to_dict()
-        self.redis_client.rpush(queue_key, json.dumps(message_data))
+        await offload_media(message)
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(queue_key, encode_message(message))
+            pipe.zadd(self._pending_key, {str(user_id): time.time()}, nx=True)
+            await pipe.execute()
 
-    def dequeue(self, user_id: int) -> Optional[Message]:
+    async def dequeue(self, user_id: int) -> Optional[Message]:
+        messages = await self.dequeue_batch(user_id, 1)
+        if not messages:
+            return None
+        return messages[0]
+
+    async def dequeue_batch(self, user_id: int, max_count: int) -> List[Message]:
+        """Atomically pop up to max_count messages for one user in a single round trip."""
         queue_key = self._get_queue_key(user_id)
-        message_json = self.redis_client.lpop(queue_key)
-        if message_json is None:
+        items = await self._batch_pop(keys=[queue_key, self._pending_key], args=[max_count, user_id])
+        return self._decode_items(user_id, items)
+
+    @staticmethod
+    def _decode_items(user_id: int, items: List[bytes]) -> List[Message]:
+        """Decode popped entries one by one. A broken entry is already off the queue, so it is logged and dropped."""
+        messages = []
+        for item in items:
+            try:
+                messages.append(decode_message(item))
+            except Exception as e:
+                logger.error(f"Dropping outbound message of user {user_id} that can't be decoded: {e}")
+        return messages
+
+    async def dequeue_many(self, user_ids: Iterable[int], max_count: int) -> Dict[int, List[Message]]:
+        """
+        Drain up to max_count messages from each user's queue with one pipelined round trip.
+        Users whose queue was empty are left out of the result.
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                await self._batch_pop(keys=[self._get_queue_key(user_id), self._pending_key],
+                                      args=[max_count, user_id], client=pipe)
+            results = await pipe.execute()
+        batches: Dict[int, List[Message]] = {}
+        for user_id, items in zip(user_ids, results):
+            messages = self._decode_items(user_id, items)
+            if messages:
+                batches[user_id] = messages
+        return batches
+
+    async def get_pending_user_ids(self, limit: Optional[int] = None) -> List[int]:
+        """Users that have undelivered messages, the longest-waiting first."""
+        end = -1 if limit is None else limit - 1
+        user_ids = await self.redis_client.zrange(self._pending_key, 0, end)
+        return [int(user_id) for user_id in user_ids]
+
+    async def mark_pending(self, user_id: int) -> None:
+        """Put a user back in the pending index, e.g. after a failed delivery left their queue non-empty."""
+        await self.redis_client.zadd(self._pending_key, {str(user_id): time.time()}, nx=True)
+
+    async def wait_for_pending_user(self, timeout: int) -> Optional[int]:
+        """
+        Block until some user has pending messages and take them off the index (BZPOPMIN).
+        Returns None if nothing arrived within timeout seconds.
+        """
+        res = await self.redis_client.bzpopmin(self._pending_key, timeout=timeout)
+        if res is None:
             return None
-        message_data = json.loads(message_json)
-        return Message.from_dict(message_data)
+        _, user_id, _ = res
+        return int(user_id)
 
-    def get_length(self, user_id: int) -> int:
+    async def get_length(self, user_id: int) -> int:
         queue_key = self._get_queue_key(user_id)
-        return self.redis_client.llen(queue_key)
+        return await self.redis_client.llen(queue_key)
+
+
+# Takes the lease of partition KEYS[1] for consumer ARGV[1], or renews it if that consumer already
+# holds it, for ARGV[2] seconds. Returns 1 if the consumer holds the lease afterwards.
+HOLD_PARTITION_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', tonumber(ARGV[2]))
+return 1
+"""
+
+# How long a partition stays with a consumer that stopped renewing its lease
+PARTITION_LEASE_SECONDS = 30
+
+
+class ChatMessageStream:
+    """
+    Outbound queue on Redis Streams read through a consumer group. An entry stays pending
+    until the worker that read it acks it after a successful send, so a failed send is
+    retried instead of lost, and several bot processes can share the work.
+
+    Users are hashed into a fixed number of partitions, each a stream of its own, and a
+    partition is read by one consumer at a time, the holder of its lease. All messages of a
+    user therefore go through one consumer, which sends them in order. Entries a consumer
+    is still working on are kept from going idle (keep_alive), so only entries of a consumer
+    that died are taken over with XAUTOCLAIM.
+    """
+
+    def __init__(self, stream_key: str = "chat_message_stream", group_name: str = "delivery"):
+        self.redis_client = async_redis_binary_client
+        self.stream_key = stream_key
+        self.group_name = group_name
+        self._maxlen: int = config.cronjob_settings['delivery_stream_maxlen']
+        # Must be the same in every process that shares the streams
+        self.partitions: int = config.cronjob_settings['delivery_stream_partitions']
+        self._hold_partition = self.redis_client.register_script(HOLD_PARTITION_SCRIPT)
+        self._claim_cursors: Dict[int, str] = {}
+
+    def partition_of(self, user_id: int) -> int:
+        return user_id % self.partitions
+
+    def _partition_key(self, partition: int) -> str:
+        return f"{self.stream_key}:{partition}"
+
+    def _lease_key(self, partition: int) -> str:
+        return f"{self.stream_key}:{partition}:lease"
+
+    @staticmethod
+    def new_consumer_name(partition: int = 0) -> str:
+        return f"{socket.gethostname()}-{os.getpid()}-{partition}"
+
+    async def ensure_group(self) -> None:
+        for partition in range(self.partitions):
+            try:
+                await self.redis_client.xgroup_create(self._partition_key(partition), self.group_name,
+                                                      id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def hold_partition(self, partition: int, consumer: str) -> bool:
+        """Take or renew the lease of a partition. Returns False if another consumer holds it."""
+        held = await self._hold_partition(keys=[self._lease_key(partition)],
+                                          args=[consumer, PARTITION_LEASE_SECONDS])
+        return bool(held)
+
+    async def enqueue(self, user_id: int, message: Message) -> None:
+        await offload_media(message)
+        await self.redis_client.xadd(self._partition_key(self.partition_of(user_id)),
+                                     {"user_id": str(user_id), "message": encode_message(message)},
+                                     maxlen=self._maxlen, approximate=True)
+
+    async def read(self, partition: int, consumer: str, count: int, block_ms: int) -> List[Tuple[str, Message]]:
+        """Read new entries of a partition, blocking up to block_ms. They stay pending until acked."""
+        res = await self.redis_client.xreadgroup(self.group_name, consumer, {self._partition_key(partition): ">"},
+                                                 count=count, block=block_ms)
+        if not res:
+            return []
+        _, entries = res[0]
+        return await self._decode_entries(partition, [(entry_id, fields) for entry_id, fields in entries if fields])
+
+    async def _decode_entries(self, partition: int, entries: List[Tuple[str, Dict]]) -> List[Tuple[str, Message]]:
+        """Decode each entry on its own. Entries that can't be decoded never will be, so they are acked and dropped."""
+        decoded, broken = [], []
+        for entry_id, fields in entries:
+            try:
+                decoded.append((entry_id, decode_message(fields[b"message"])))
+            except Exception as e:
+                logger.error(f"Dropping outbound message {entry_id} that can't be decoded: {e}")
+                broken.append(entry_id)
+        await self.ack(partition, *broken)
+        return decoded
+
+    async def ack(self, partition: int, *entry_ids: str) -> int:
+        if not entry_ids:
+            return 0
+        return await self.redis_client.xack(self._partition_key(partition), self.group_name, *entry_ids)
+
+    async def keep_alive(self, partition: int, consumer: str, *entry_ids: str) -> None:
+        """Reset the idle time of entries this consumer is still working on, so they are not claimed."""
+        if not entry_ids:
+            return
+        # JUSTID leaves the delivery count alone
+        await self.redis_client.xclaim(self._partition_key(partition), self.group_name, consumer,
+                                       min_idle_time=0, message_ids=list(entry_ids), justid=True)
+
+    async def claim_stale(self, partition: int, consumer: str, min_idle_ms: int, count: int,
+                          max_attempts: int) -> List[Tuple[str, Message]]:
+        """
+        Take over entries of a partition that were read but not acked or kept alive for at least
+        min_idle_ms, i.e. those of a consumer that died. Entries that were already delivered
+        max_attempts times are acked and dropped.
+        """
+        stream_key = self._partition_key(partition)
+        start_id = self._claim_cursors.get(partition, "0-0")
+        res = await self.redis_client.xautoclaim(stream_key, self.group_name, consumer,
+                                                 min_idle_time=min_idle_ms, start_id=start_id, count=count)
+        next_id, entries = res[0], res[1]
+        self._claim_cursors[partition] = next_id
+        entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+        if not entries:
+            return []
+
+        pending = await self.redis_client.xpending_range(stream_key, self.group_name,
+                                                         min=entries[0][0], max=entries[-1][0],
+                                                         count=len(entries), consumername=consumer)
+        attempts = {p["message_id"]: p["times_delivered"] for p in pending}
+        # The attempt limit is checked before decoding, so an entry that fails to decode is dropped too
+        claimable, dropped = [], []
+        for entry_id, fields in entries:
+            if attempts.get(entry_id, 0) > max_attempts:
+                dropped.append(entry_id)
+                logger.error(f"Dropping outbound message {entry_id} after {max_attempts} failed delivery attempts")
+                await self._release_blob(fields)
+            else:
+                claimable.append((entry_id, fields))
+        await self.ack(partition, *dropped)
+        return await self._decode_entries(partition, claimable)
+
+    @staticmethod
+    async def _release_blob(fields: Dict):
+        # Only the header is needed to find the blob reference of a dropped entry
+        try:
+            data = fields[b"message"]
+            if data[:1] == b"{":
+                return
+            (header_length,) = struct.unpack_from(">I", data)
+            digest = json.loads(data[4:4 + header_length]).get("digest")
+        except Exception as e:
+            logger.error(f"Can't read the header of a dropped outbound message: {e}")
+            return
+        if digest is not None:
+            await blob_store.release(digest)
 
 
-chat_message_store = ChatMessageStore()
+# The stream replaces the per-user lists as the outbound queue in "stream" delivery mode
+chat_message_stream = ChatMessageStream()
+chat_message_store = chat_message_stream if config.cronjob_settings['delivery_mode'] == "stream" else ChatMessageStore()
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import io
+import mmap
+import os
+import socket
+import time
+from typing import Union, List
+
+from src.redis.redis_client import async_redis_client
+from src.utils.config import config
+from src.utils.logger import logger
+
+# Decrements the reference count of blob ARGV[1]. When it reaches zero the digest is moved to
+# the garbage set KEYS[2] (scored by ARGV[2], the current time) instead of being deleted right
+# away, so a concurrent put() of the same content can still revive it.
+RELEASE_SCRIPT = """
+local refs = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if refs <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+end
+return refs
+"""
+
+# How long a host's claim on the blob store lasts unless it is renewed
+HOST_CLAIM_TTL_SECONDS = 60
+
+
+class BlobStore:
+    """
+    Content-addressed store for voice and image payloads on the local filesystem.
+
+    Blobs are keyed by their sha256 digest and written once. Queue entries and history rows
+    hold a reference each; reference counts live in Redis so every bot process on the host
+    shares them. Blobs nobody references any more are removed by collect_garbage() after a
+    grace period.
+
+    Queue entries only carry the digest, so whoever delivers them must see the same files.
+    Unless `shared_root` says root is on storage every host mounts, delivery workers take
+    a claim on the store with claim_host(), and one on a second host refuses to start.
+    """
+
+    def __init__(self, root: str, gc_grace_seconds: int, shared_root: bool = False):
+        self.root = root
+        self.gc_grace_seconds = gc_grace_seconds
+        self.shared_root = shared_root
+        self.redis_client = async_redis_client
+        self._refcount_key = "blob_store:refcount"
+        self._garbage_key = "blob_store:garbage"
+        self._host_key = "blob_store:host"
+        self._release = self.redis_client.register_script(RELEASE_SCRIPT)
+
+    def _get_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _write_once(self, digest: str, data: Union[bytes, memoryview]):
+        path = self._get_path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        # Identical content under the same name, so losing a race to another writer is harmless
+        os.replace(tmp_path, path)
+
+    async def put(self, data: Union[bytes, memoryview]) -> str:
+        """Store data if it is new and take a reference to it. Returns its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hincrby(self._refcount_key, digest, 1)
+            pipe.zrem(self._garbage_key, digest)
+            await pipe.execute()
+        await asyncio.to_thread(self._write_once, digest, data)
+        return digest
+
+    async def retain(self, digest: str) -> int:
+        return await self.redis_client.hincrby(self._refcount_key, digest, 1)
+
+    async def release(self, digest: str) -> int:
+        return await self._release(keys=[self._refcount_key, self._garbage_key], args=[digest, time.time()])
+
+    def open(self, digest: str) -> Union[mmap.mmap, io.BytesIO]:
+        """
+        Map a blob read-only into memory. The mapping is file-like (read/seek/tell), so it can be
+        handed to the Telegram client directly without copying the payload through Python first.
+        """
+        with open(self._get_path(digest), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return io.BytesIO()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def claim_host(self):
+        """
+        Claim the store for this host, or renew the claim, for HOST_CLAIM_TTL_SECONDS.
+        Raises RuntimeError if a process on another host holds it.
+        """
+        if self.shared_root:
+            return
+        host = socket.gethostname()
+        if await self.redis_client.set(self._host_key, host, nx=True, ex=HOST_CLAIM_TTL_SECONDS):
+            return
+        owner = await self.redis_client.get(self._host_key)
+        if owner is not None and owner != host:
+            raise RuntimeError(f"Blob store at {self.root} is local to host {owner}; delivering from {host} "
+                               f"needs blob_store_settings.shared_root on storage both hosts mount")
+        await self.redis_client.set(self._host_key, host, ex=HOST_CLAIM_TTL_SECONDS)
+
+    async def hold_host(self):
+        """Keep renewing the claim of this host for as long as it runs."""
+        while True:
+            await asyncio.sleep(HOST_CLAIM_TTL_SECONDS / 3)
+            try:
+                await self.claim_host()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to renew the blob store claim: {e}")
+
+    async def collect_garbage(self) -> int:
+        """Delete blobs that have been unreferenced for longer than the grace period."""
+        deadline = time.time() - self.gc_grace_seconds
+        digests: List[str] = await self.redis_client.zrangebyscore(self._garbage_key, "-inf", deadline)
+        removed = 0
+        for digest in digests:
+            await self.redis_client.zrem(self._garbage_key, digest)
+            if await self.redis_client.hexists(self._refcount_key, digest):
+                # Revived by a put() since it was released
+                continue
+            path = self._get_path(digest)
+            doomed_path = f"{path}.{os.getpid()}.gc"
+            try:
+                await asyncio.to_thread(os.rename, path, doomed_path)
+            except FileNotFoundError:
+                continue
+            # A put() racing with us either saw the file missing and rewrote it,
+            # or saw it present and skipped the write; in that case put it back.
+            if await self.redis_client.hexists(self._refcount_key, digest):
+                await asyncio.to_thread(os.replace, doomed_path, path)
+            else:
+                await asyncio.to_thread(os.remove, doomed_path)
+                removed += 1
+        if removed:
+            logger.info(f"Blob store removed {removed} unreferenced blobs")
+        return removed
+
+
+blob_store = BlobStore(root=config.blob_store_settings['root'],
+                       gc_grace_seconds=config.blob_store_settings['gc_grace_seconds'],
+                       shared_root=config.blob_store_settings['shared_root'])
@@ -1,4 +1,11 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
 import psycopg2
+from psycopg2 import pool
+from psycopg_pool import AsyncConnectionPool
 
 from src.utils.config import config
 from src.utils.logger import logger
@@ -10,16 +17,140 @@ DBNAME = "myaichatmate"
 USER = config.postgres_db_username
 PASSWORD = config.postgres_db_password
 
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=HOST,
-            port=PORT,
-            dbname=DBNAME,
-            user=USER,
-            password=PASSWORD
-        )
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to database: {e}")
-        return None
+POOL_MIN_SIZE = config.postgres_db['pool_min_size']
+POOL_MAX_SIZE = config.postgres_db['pool_max_size']
+POOL_TIMEOUT = config.postgres_db['pool_timeout']
+HEALTH_CHECK_IDLE_SECONDS = config.postgres_db['health_check_idle_seconds']
+
+
+class ConnectionPool:
+    """
+    Process-wide pool of psycopg2 connections.
+
+    Borrowing blocks for up to POOL_TIMEOUT seconds when all POOL_MAX_SIZE connections are in
+    use. A connection that sat idle longer than HEALTH_CHECK_IDLE_SECONDS is pinged before it
+    is handed out, and replaced if the server dropped it.
+    """
+
+    def __init__(self, min_size: int, max_size: int, timeout: float, health_check_idle_seconds: float):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_idle_seconds = health_check_idle_seconds
+        self._pool: Optional[pool.ThreadedConnectionPool] = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used: dict[int, float] = {}
+
+    def _get_pool(self) -> pool.ThreadedConnectionPool:
+        with self._lock:
+            if self._pool is None:
+                self._pool = pool.ThreadedConnectionPool(
+                    self.min_size,
+                    self.max_size,
+                    host=HOST,
+                    port=PORT,
+                    dbname=DBNAME,
+                    user=USER,
+                    password=PASSWORD
+                )
+                logger.info(f"Created Postgres connection pool ({self.min_size}-{self.max_size} connections)")
+            return self._pool
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.health_check_idle_seconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def borrow(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise pool.PoolError(f"No database connection available after {self.timeout} seconds")
+        try:
+            db_pool = self._get_pool()
+            conn = db_pool.getconn()
+            if not self._is_healthy(conn):
+                logger.info("Replacing a broken database connection")
+                self._last_used.pop(id(conn), None)
+                db_pool.putconn(conn, close=True)
+                conn = db_pool.getconn()
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def give_back(self, conn):
+        try:
+            # The pool rolls back any transaction the borrower left open
+            self._last_used[id(conn)] = time.monotonic()
+            self._get_pool().putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[Optional["psycopg2.extensions.connection"]]:
+        """Borrow a connection for the duration of the block. Yields None if the database is unreachable."""
+        try:
+            conn = self.borrow()
+        except Exception as e:
+            logger.error(f"Error connecting to database: {e}")
+            yield None
+            return
+        try:
+            yield conn
+        finally:
+            self.give_back(conn)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+connection_pool = ConnectionPool(POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_TIMEOUT, HEALTH_CHECK_IDLE_SECONDS)
+
+
+def get_connection():
+    return connection_pool.connection()
+
+
+# Asyncio pool (psycopg 3) for coroutines, so queries never block the event loop.
+# It is opened by the bot at startup with open_async_pool().
+async_connection_pool = AsyncConnectionPool(
+    kwargs={
+        "host": HOST,
+        "port": PORT,
+        "dbname": DBNAME,
+        "user": USER,
+        "password": PASSWORD,
+    },
+    min_size=POOL_MIN_SIZE,
+    max_size=POOL_MAX_SIZE,
+    timeout=POOL_TIMEOUT,
+    max_idle=HEALTH_CHECK_IDLE_SECONDS * 10,
+    check=AsyncConnectionPool.check_connection,
+    open=False
+)
+
+
+async def open_async_pool():
+    await async_connection_pool.open()
+    logger.info(f"Opened async Postgres connection pool ({POOL_MIN_SIZE}-{POOL_MAX_SIZE} connections)")
+
+
+async def close_async_pool():
+    await async_connection_pool.close()
+
+
+def get_async_connection():
+    """Borrow a connection; the transaction is committed when the block exits cleanly, rolled back otherwise."""
+    return async_connection_pool.connection()
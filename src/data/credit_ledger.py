@@ -0,0 +1,139 @@
+import uuid
+from dataclasses import replace
+from datetime import datetime
+from typing import Optional
+
+from src.data.connect_db import get_connection, get_async_connection
+from src.data.user_info import UserInfo, apply_debits_async, user_info_cache
+from src.redis.redis_client import async_redis_client
+from src.utils.config import config
+from src.utils.logger import logger
+
+settlement_table_name = "credit_settlements"
+
+# Moves the pending debits KEYS[1] to the settling hash KEYS[2] and tags the batch with the id
+# ARGV[1] (stored in KEYS[3]). A batch left over from a settlement that did not finish is
+# returned as is, so it is retried before any new debits are taken.
+STAGE_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.call('GET', KEYS[3])
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+redis.call('RENAME', KEYS[1], KEYS[2])
+redis.call('SET', KEYS[3], ARGV[1])
+return ARGV[1]
+"""
+
+# Deletes the settling hash KEYS[1] and its batch id KEYS[2], but only if they still belong
+# to batch ARGV[1]: a slower process finishing the same batch must not delete a newer one.
+FINISH_SCRIPT = """
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1], KEYS[2])
+end
+return 0
+"""
+
+INSERT_SETTLEMENT_QUERY = f"""
+INSERT INTO {settlement_table_name} (batch_id, settled_at, users, total_debit)
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (batch_id) DO NOTHING;
+"""
+
+
+class CreditLedger:
+    """
+    Credits spent on delivered messages are debited in Redis with a single HINCRBY, which is
+    atomic however many deliveries for a user run at once. settle() periodically folds the
+    pending debits into users.credits in one UPDATE per batch. Each batch is recorded in
+    credit_settlements in the same transaction, so a batch retried after a crash is not
+    charged twice.
+    """
+
+    def __init__(self):
+        self.redis_client = async_redis_client
+        self._pending_key = "credit_ledger:pending"
+        self._settling_key = "credit_ledger:settling"
+        self._batch_id_key = "credit_ledger:settling:batch_id"
+        self._stage = self.redis_client.register_script(STAGE_SCRIPT)
+        self._finish = self.redis_client.register_script(FINISH_SCRIPT)
+        # The last batch this process saw committed. Its settling hash is already in users.credits,
+        # so it must not be subtracted again until it is deleted.
+        self._committed_batch_id: Optional[str] = None
+
+    def setup_schema(self):
+        with get_connection() as conn:
+            if conn is None:
+                return
+            try:
+                cur = conn.cursor()
+                cur.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {settlement_table_name} (
+                        batch_id TEXT PRIMARY KEY,
+                        settled_at TIMESTAMP NOT NULL,
+                        users INTEGER NOT NULL,
+                        total_debit BIGINT NOT NULL
+                    );
+                """)
+                conn.commit()
+                logger.info(f"Schema of {settlement_table_name} is up to date.")
+            except Exception as e:
+                logger.error(f"Error setting up {settlement_table_name} schema: {e}")
+                conn.rollback()
+
+    async def debit(self, user_id: int, amount: int) -> int:
+        """Record a debit. Returns the user's total of debits not yet settled."""
+        return await self.redis_client.hincrby(self._pending_key, str(user_id), amount)
+
+    async def get_pending_debit(self, user_id: int) -> int:
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hget(self._pending_key, str(user_id))
+            pipe.hget(self._settling_key, str(user_id))
+            pipe.get(self._batch_id_key)
+            pending, settling, batch_id = await pipe.execute()
+        if batch_id is not None and batch_id == self._committed_batch_id:
+            settling = 0
+        return int(pending or 0) + int(settling or 0)
+
+    async def with_pending_debits(self, user_info: Optional[UserInfo]) -> Optional[UserInfo]:
+        """The user's balance as of now, i.e. with debits that are not settled yet taken off."""
+        if user_info is None:
+            return None
+        pending_debit = await self.get_pending_debit(user_info.user_id)
+        if pending_debit == 0:
+            return user_info
+        return replace(user_info, credits=user_info.credits - pending_debit)
+
+    async def settle(self) -> int:
+        """Write pending debits to Postgres. Returns the number of users charged."""
+        batch_id = await self._stage(keys=[self._pending_key, self._settling_key, self._batch_id_key],
+                                     args=[uuid.uuid4().hex])
+        if batch_id is None:
+            return 0
+        debits = {int(user_id): int(amount)
+                  for user_id, amount in (await self.redis_client.hgetall(self._settling_key)).items()
+                  if int(amount) != 0}
+        updated = []
+        if debits:
+            async with get_async_connection() as conn:
+                cur = await conn.execute(INSERT_SETTLEMENT_QUERY,
+                                         (batch_id, datetime.now(), len(debits), sum(debits.values())))
+                if cur.rowcount == 1:
+                    updated = await apply_debits_async(conn, debits)
+                else:
+                    logger.info(f"Credit batch {batch_id} was already settled")
+        # Committed. Before the next await, stop counting the batch as pending and serve the new
+        # balances, so no reader sees the debits both settled and pending.
+        self._committed_batch_id = batch_id
+        for user_info in updated:
+            user_info_cache.put_local(user_info)
+        await self._finish(keys=[self._settling_key, self._batch_id_key], args=[batch_id])
+        for user_info in updated:
+            await user_info_cache.put(user_info)
+        if updated:
+            logger.info(f"Settled credits of {len(updated)} users in batch {batch_id}")
+        return len(updated)
+
+
+credit_ledger = CreditLedger()
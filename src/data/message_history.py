@@ -1,79 +1,423 @@
-from src.data.connect_db import connect_db
+import asyncio
+import gzip
+import os
+import re
+from datetime import datetime, date
+from typing import List, Optional, AsyncIterator, Tuple
+
+import psycopg
+
+from src.data.blob_store import blob_store
+from src.data.connect_db import get_connection, get_async_connection, open_async_pool, close_async_pool
 import io
 from src.data.Message import Message, MessageType
+from src.utils.config import config
 from src.utils.logger import logger
 
 table_name = "message_history"
+legacy_table_name = f"{table_name}_legacy"
+message_columns = "user_id, message_type, prompt, content_text, content_blob, content_digest, timestamp"
+partition_name_pattern = re.compile(rf"^{table_name}_(\d{{4}})_(\d{{2}})$")
+
+def _add_months(day: date, months: int) -> date:
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def _partition_name(month_start: date) -> str:
+    return f"{table_name}_{month_start.year:04d}_{month_start.month:02d}"
+
+def setup_schema():
+    """
+    Create message_history as a table partitioned by month on timestamp. An unpartitioned
+    message_history from older versions is kept as the partition message_history_legacy,
+    which covers everything up to the end of the current month.
+    """
+    with get_connection() as conn:
+        if conn is None:
+            return
+
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table_name,))
+            row = cur.fetchone()
+            migrate_legacy = row is not None and row[0] == 'r'
+            if migrate_legacy:
+                # Committed on their own: HistoryWriter copies into these columns, so they must
+                # exist even if the partition migration below fails and the table stays as it is.
+                # Media delivered through the blob store is kept as a digest instead of inline bytes.
+                cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS content_digest TEXT;")
+                cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS id BIGSERIAL;")
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error adding columns to {table_name}: {e}")
+            conn.rollback()
+            return
+
+        try:
+            if migrate_legacy:
+                cur.execute(f"ALTER TABLE {table_name} RENAME TO {legacy_table_name};")
+                cur.execute(f"ALTER INDEX IF EXISTS {table_name}_user_id_timestamp_idx "
+                            f"RENAME TO {legacy_table_name}_user_id_timestamp_idx;")
+            # id is the tie-breaker for keyset pagination, since timestamps of one user are not unique
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    id BIGSERIAL,
+                    user_id BIGINT NOT NULL,
+                    message_type TEXT NOT NULL,
+                    prompt TEXT,
+                    content_text TEXT,
+                    content_blob BYTEA,
+                    content_digest TEXT,
+                    timestamp TIMESTAMP NOT NULL
+                ) PARTITION BY RANGE (timestamp);
+            """)
+            cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS {table_name}_user_id_timestamp_idx
+                ON {table_name} (user_id, timestamp, id);
+            """)
+            if migrate_legacy:
+                legacy_end = _add_months(date.today(), 1)
+                cur.execute(f"ALTER TABLE {table_name} ATTACH PARTITION {legacy_table_name} "
+                            f"FOR VALUES FROM (MINVALUE) TO ('{legacy_end.isoformat()}');")
+                cur.execute(f"""
+                    SELECT setval(pg_get_serial_sequence('{table_name}', 'id'),
+                                  (SELECT COALESCE(max(id), 0) + 1 FROM {legacy_table_name}), false);
+                """)
+                logger.info(f"Attached the unpartitioned {table_name} as {legacy_table_name}.")
+            conn.commit()
+            logger.info(f"Schema of {table_name} is up to date.")
+        except Exception as e:
+            conn.rollback()
+            if migrate_legacy:
+                # History is still written, but to the unpartitioned table, which retention never trims
+                logger.critical(f"Migrating {table_name} to monthly partitions failed, it stays unpartitioned: {e}")
+            else:
+                logger.error(f"Error setting up {table_name} schema: {e}")
+
+async def ensure_partitions(months_ahead: int = config.postgres_db['history_partitions_ahead']) -> int:
+    """Create the partitions of this month and the next months_ahead months if they are missing."""
+    created = 0
+    this_month = date.today().replace(day=1)
+    async with get_async_connection() as conn:
+        for offset in range(months_ahead + 1):
+            start = _add_months(this_month, offset)
+            end = _add_months(start, 1)
+            name = _partition_name(start)
+            try:
+                async with conn.transaction():
+                    cur = await conn.execute("SELECT to_regclass(%s) IS NULL;", (name,))
+                    if not (await cur.fetchone())[0]:
+                        continue
+                    await conn.execute(f"CREATE TABLE {name} PARTITION OF {table_name} "
+                                       f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}');")
+                    created += 1
+            except psycopg.errors.InvalidObjectDefinition:
+                # The month is still covered by the legacy partition
+                continue
+    if created:
+        logger.info(f"Created {created} {table_name} partitions.")
+    return created
+
+def _expired_partitions(retention_months: int) -> List[str]:
+    cutoff = _add_months(date.today().replace(day=1), -retention_months)
+    with get_connection() as conn:
+        if conn is None:
+            return []
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s);
+        """, (table_name,))
+        expired = []
+        for (name,) in cur.fetchall():
+            match = partition_name_pattern.match(name)
+            if match and _add_months(date(int(match[1]), int(match[2]), 1), 1) <= cutoff:
+                expired.append(name)
+        return sorted(expired)
+
+def _drop_partition(name: str, archive_dir: Optional[str]) -> List[Tuple[str, int]]:
+    """
+    Export a partition to a gzipped CSV file if archive_dir is set, then detach and drop it.
+    Returns the blob digests its rows referenced, with their reference counts.
+    """
+    with get_connection() as conn:
+        if conn is None:
+            raise ConnectionError(f"Cannot drop {name}: database unavailable")
+        try:
+            cur = conn.cursor()
+            if archive_dir:
+                os.makedirs(archive_dir, exist_ok=True)
+                path = os.path.join(archive_dir, f"{name}.csv.gz")
+                with gzip.open(path, "wb") as f:
+                    cur.copy_expert(f"COPY (SELECT {message_columns} FROM {name} ORDER BY timestamp, id) "
+                                    f"TO STDOUT WITH (FORMAT csv, HEADER)", f)
+                logger.info(f"Archived {name} to {path}.")
+            cur.execute(f"""
+                SELECT content_digest, count(*) FROM {name}
+                WHERE content_digest IS NOT NULL GROUP BY content_digest;
+            """)
+            digests = cur.fetchall()
+            cur.execute(f"ALTER TABLE {table_name} DETACH PARTITION {name};")
+            cur.execute(f"DROP TABLE {name};")
+            conn.commit()
+            return digests
+        except Exception:
+            conn.rollback()
+            raise
+
+async def apply_retention(retention_months: int = config.postgres_db['history_retention_months'],
+                          archive_dir: Optional[str] = config.postgres_db['history_archive_dir']) -> int:
+    """
+    Drop monthly partitions older than retention_months, archiving them first when archive_dir
+    is set. The archive keeps blob digests only; the blobs themselves are released here and
+    collected by the blob store. A retention of 0 keeps everything, and so does the legacy
+    partition, which is never dropped automatically.
+    """
+    if retention_months <= 0:
+        return 0
+    dropped = 0
+    for name in await asyncio.to_thread(_expired_partitions, retention_months):
+        try:
+            digests = await asyncio.to_thread(_drop_partition, name, archive_dir)
+        except Exception as e:
+            logger.error(f"Error dropping {table_name} partition {name}: {e}")
+            continue
+        # Dropped before released: a crash in between leaks blobs rather than losing live ones
+        for digest, refs in digests:
+            for _ in range(refs):
+                await blob_store.release(digest)
+        dropped += 1
+        logger.info(f"Dropped {table_name} partition {name}.")
+    return dropped
 
-def insert_message(msg: Message):
-    conn = connect_db()
-    if conn is None:
-        return
+async def maintain_partitions():
+    await ensure_partitions()
+    await apply_retention()
+
+INSERT_MESSAGE_QUERY = f"""
+    INSERT INTO {table_name} (
+        user_id,
+        message_type,
+        prompt,
+        content_text,
+        content_blob,
+        content_digest,
+        timestamp
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s);
+"""
 
+def _message_row(msg: Message) -> tuple:
     content_text = None
     content_blob = None
+    content_digest = None
 
     if isinstance(msg.content, str):
         content_text = msg.content
+    elif msg.digest is not None:
+        content_digest = msg.digest
     elif isinstance(msg.content, io.BytesIO):
         msg.content.seek(0)
         content_blob = msg.content.read()
 
+    return (
+        msg.user_id,
+        msg.message_type.value,
+        msg.prompt,
+        content_text,
+        content_blob,
+        content_digest,
+        msg.timestamp
+    )
+
+def insert_message(msg: Message) -> bool:
+    row = _message_row(msg)
+    with get_connection() as conn:
+        if conn is None:
+            return False
+
+        try:
+            cur = conn.cursor()
+            cur.execute(INSERT_MESSAGE_QUERY, row)
+            conn.commit()
+            logger.info(f"{msg.message_type.value.capitalize()} message stored for user {msg.user_id}.")
+            return True
+        except Exception as e:
+            logger.info(f"Error inserting message: {e}")
+            conn.rollback()
+            return False
+
+async def insert_message_async(msg: Message) -> bool:
+    row = _message_row(msg)
     try:
-        cur = conn.cursor()
-        query = f"""
-            INSERT INTO {table_name} (
-                user_id,
-                message_type,
-                prompt,
-                content_text,
-                content_blob,
-                timestamp
-            )
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """
-        cur.execute(query, (
-            msg.user_id,
-            msg.message_type.value,
-            msg.prompt,
-            content_text,
-            content_blob,
-            msg.timestamp
-        ))
-        conn.commit()
+        async with get_async_connection() as conn:
+            await conn.execute(INSERT_MESSAGE_QUERY, row)
         logger.info(f"{msg.message_type.value.capitalize()} message stored for user {msg.user_id}.")
+        return True
     except Exception as e:
         logger.info(f"Error inserting message: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        return False
+
+class HistoryWriter:
+    """
+    Buffers delivered messages and writes them to message_history with one COPY per batch.
+
+    A batch is flushed once batch_size rows are waiting or flush_interval_ms after its first
+    row arrived. write() blocks when max_pending rows are queued, so a slow database pushes
+    back on delivery instead of growing memory. stop() flushes whatever is left.
+    """
+
+    def __init__(self, flush_interval_ms: int, batch_size: int, max_pending: int, max_retries: int = 3):
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def write(self, msg: Message):
+        await self._queue.put(_message_row(msg))
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # A dead task would never take the stop marker off a full queue
+        if not self._task.done():
+            await self._queue.put(None)
+        try:
+            await self._task
+        except Exception as e:
+            logger.error(f"History writer died, {self._queue.qsize()} messages were not stored: {e}")
+        self._task = None
+        logger.info("History writer flushed and stopped")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self._queue.get()
+            if row is None:
+                break
+            batch = [row]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+            # A failed batch must not end the loop, or write() blocks delivery once the queue is full
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                logger.error(f"Error flushing {len(batch)} messages to {table_name}: {e}")
+
+    async def _flush(self, rows: List[tuple]):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                async with get_async_connection() as conn:
+                    async with conn.cursor() as cur:
+                        async with cur.copy(f"COPY {table_name} ({message_columns}) FROM STDIN") as copy:
+                            for row in rows:
+                                await copy.write_row(row)
+                logger.info(f"Stored {len(rows)} messages in {table_name}.")
+                return
+            except Exception as e:
+                logger.error(f"Error writing {len(rows)} messages to {table_name} (attempt {attempt}): {e}")
+                await asyncio.sleep(attempt)
+        # The rows are lost; give back the blob references they would have held
+        for row in rows:
+            content_digest = row[5]
+            if content_digest is None:
+                continue
+            try:
+                await blob_store.release(content_digest)
+            except Exception as e:
+                # Leaks the blob rather than giving up on the rest of the batch
+                logger.error(f"Error releasing blob {content_digest}: {e}")
 
-def fetch_user_messages(user_id: int):
-    conn = connect_db()
-    if conn is None:
-        return
+def _build_history_page_query(user_id: int, include_blobs: bool, since: Optional[datetime],
+                              last_key: Optional[tuple], page_size: int):
+    content_blob = "content_blob" if include_blobs else "NULL"
+    query = f"""
+    SELECT id, message_type, prompt, content_text, {content_blob}, content_digest, timestamp
+    FROM {table_name}
+    WHERE user_id = %s"""
+    values = [user_id]
 
+    if last_key is not None:
+        query += " AND (timestamp, id) > (%s, %s)"
+        values.extend(last_key)
+    elif since is not None:
+        query += " AND timestamp >= %s"
+        values.append(since)
+
+    query += " ORDER BY timestamp, id LIMIT %s;"
+    values.append(page_size)
+    return query, tuple(values)
+
+def _row_to_message(user_id: int, row: tuple, include_blobs: bool) -> Message:
+    _, msg_type, prompt, text, blob, digest, ts = row
+    if text is not None:
+        content = text
+    elif include_blobs and digest is not None:
+        content = blob_store.open(digest)
+    elif include_blobs and blob is not None:
+        content = io.BytesIO(blob)
+    else:
+        content = None
+    return Message(MessageType(msg_type), content, prompt, user_id, timestamp=ts, digest=digest)
+
+async def iter_user_messages(user_id: int, include_blobs: bool = False, since: Optional[datetime] = None,
+                             page_size: int = config.postgres_db['history_page_size']) -> AsyncIterator[Message]:
+    """
+    Yield a user's messages oldest first, in constant memory.
+
+    Pages are read by keyset on (user_id, timestamp, id), so each one is an index range scan
+    no matter how far into the history it is, and through a server-side cursor, so not even a
+    page of blobs is held in memory at once. Without include_blobs the media content of the
+    yielded messages is None; blobs from the blob store are memory-mapped, not read.
+    """
+    last_key = None
+    while True:
+        query, values = _build_history_page_query(user_id, include_blobs, since, last_key, page_size)
+        rows = 0
+        async with get_async_connection() as conn:
+            async with conn.cursor(name=f"{table_name}_{user_id}") as cur:
+                cur.itersize = min(page_size, 100)
+                await cur.execute(query, values)
+                async for row in cur:
+                    rows += 1
+                    last_key = (row[6], row[0])
+                    yield _row_to_message(user_id, row, include_blobs)
+        if rows < page_size:
+            return
+
+async def fetch_user_messages(user_id: int):
     try:
-        cur = conn.cursor()
-        query = f"""
-        SELECT message_type, prompt, content_text, content_blob, timestamp
-        FROM {table_name}
-        WHERE user_id = %s
-        ORDER BY timestamp;
-        """
-        cur.execute(query, (user_id,))
-        rows = cur.fetchall()
-        for msg_type, prompt, text, blob, ts in rows:
-            print(f"\n[{ts}] Prompt: {prompt}")
-            print(f"Type: {msg_type}")
-            if text:
-                print(f"Text Content: {text}")
-            elif blob:
-                print(f"Binary Content: {len(blob)} bytes")
+        async for msg in iter_user_messages(user_id):
+            print(f"\n[{msg.timestamp}] Prompt: {msg.prompt}")
+            print(f"Type: {msg.message_type.value}")
+            if isinstance(msg.content, str):
+                print(f"Text Content: {msg.content}")
+            elif msg.digest:
+                print(f"Blob Content: {msg.digest}")
+            else:
+                print("Binary Content")
     except Exception as e:
         print(f"Error fetching messages: {e}")
-    finally:
-        conn.close()
+
+history_writer = HistoryWriter(flush_interval_ms=config.postgres_db['history_flush_interval_ms'],
+                               batch_size=config.postgres_db['history_batch_size'],
+                               max_pending=config.postgres_db['history_max_pending'])
 
 if __name__ == '__main__':
     msg1 = Message(
@@ -92,6 +436,11 @@ if __name__ == '__main__':
         user_id=1
     )
 
+    async def main():
+        await open_async_pool()
+        await fetch_user_messages(1)
+        await close_async_pool()
+
     insert_message(msg1)
     insert_message(msg2)
-    fetch_user_messages(1)
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -1,10 +1,15 @@
-from dataclasses import dataclass
-from typing import Optional
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Optional, Dict, Tuple, List
 
-from src.data.connect_db import connect_db
+from src.data.connect_db import get_connection, get_async_connection
 import psycopg2
 from datetime import datetime
 
+from src.redis.redis_client import async_redis_client, redis_client
+from src.utils.config import config
 from src.utils.constants import UserRole
 from src.utils.logger import logger
 
@@ -20,6 +25,118 @@ class UserInfo:
     role: str
     gender: Optional[str]
 
+class UserInfoCache:
+    """
+    In-process LRU cache of UserInfo rows with a TTL, optionally backed by Redis so that
+    several bot instances share it. Writes go through the cache: update/insert refresh the
+    entry from the row the database returns, so lookups in steady state cost no query.
+    """
+
+    def __init__(self, capacity: int, ttl_seconds: float, use_redis: bool):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.use_redis = use_redis
+        self.redis_client = async_redis_client
+        self.sync_redis_client = redis_client
+        self._entries: OrderedDict[int, Tuple[float, UserInfo]] = OrderedDict()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def _get_key(self, user_id: int) -> str:
+        return f"user_info:{user_id}"
+
+    def get_local(self, user_id: int) -> Optional[UserInfo]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, user_info = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return user_info
+
+    def put_local(self, user_info: UserInfo):
+        self._entries[user_info.user_id] = (time.monotonic() + self.ttl_seconds, user_info)
+        self._entries.move_to_end(user_info.user_id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate_local(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    async def get(self, user_id: int) -> Optional[UserInfo]:
+        user_info = self.get_local(user_id)
+        if user_info is not None:
+            self.hits += 1
+            return user_info
+        if self.use_redis:
+            try:
+                data = await self.redis_client.get(self._get_key(user_id))
+            except Exception as e:
+                logger.error(f"Error reading cached user {user_id}: {e}")
+                data = None
+            if data is not None:
+                user_info = _user_info_from_json(data)
+                self.put_local(user_info)
+                self.redis_hits += 1
+                return user_info
+        self.misses += 1
+        return None
+
+    async def put(self, user_info: UserInfo):
+        self.put_local(user_info)
+        if self.use_redis:
+            try:
+                await self.redis_client.set(self._get_key(user_info.user_id), _user_info_to_json(user_info),
+                                            ex=int(self.ttl_seconds))
+            except Exception as e:
+                logger.error(f"Error caching user {user_info.user_id}: {e}")
+
+    async def invalidate(self, user_id: int):
+        self.invalidate_local(user_id)
+        if self.use_redis:
+            try:
+                await self.redis_client.delete(self._get_key(user_id))
+            except Exception as e:
+                logger.error(f"Error invalidating cached user {user_id}: {e}")
+
+    def invalidate_sync(self, user_id: int):
+        """invalidate() for the synchronous data access functions."""
+        self.invalidate_local(user_id)
+        if self.use_redis:
+            try:
+                self.sync_redis_client.delete(self._get_key(user_id))
+            except Exception as e:
+                logger.error(f"Error invalidating cached user {user_id}: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+        }
+
+
+def _user_info_to_json(user_info: UserInfo) -> str:
+    data = asdict(user_info)
+    data["created_at"] = user_info.created_at.isoformat() if user_info.created_at else None
+    data["updated_at"] = user_info.updated_at.isoformat() if user_info.updated_at else None
+    return json.dumps(data)
+
+def _user_info_from_json(data: str) -> UserInfo:
+    fields = json.loads(data)
+    for key in ("created_at", "updated_at"):
+        if fields[key] is not None:
+            fields[key] = datetime.fromisoformat(fields[key])
+    return UserInfo(**fields)
+
+user_info_cache = UserInfoCache(capacity=config.user_info_cache_settings['capacity'],
+                                ttl_seconds=config.user_info_cache_settings['ttl_seconds'],
+                                use_redis=config.user_info_cache_settings['use_redis'])
+
 def verify_user(user_info: UserInfo) -> bool:
     if user_info is None:
         return False
@@ -30,121 +147,181 @@ def verify_user(user_info: UserInfo) -> bool:
     else:
         return True
 
+USER_COLUMNS = "user_id, has_subscribed, user_name, phone_number, created_at, updated_at, gender, credits, role"
+
+GET_USER_QUERY = f"""
+SELECT {USER_COLUMNS}
+FROM users
+WHERE user_id = %s;
+"""
+
+INSERT_USER_QUERY = f"""
+INSERT INTO users (user_id, has_subscribed, user_name, phone_number, credits, created_at, updated_at, role)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+RETURNING {USER_COLUMNS};
+"""
+
+def _row_to_user_info(row) -> UserInfo:
+    return UserInfo(
+        user_id=row[0],
+        has_subscribed=row[1],
+        user_name=row[2],
+        phone_number=row[3],
+        created_at=row[4],
+        updated_at=row[5],
+        gender=row[6],
+        credits=row[7],
+        role=row[8],
+    )
+
+def _build_update_query(user_id: int, has_subscribed: bool, user_name: str, phone_number: str, credits: int):
+    query = "UPDATE users SET updated_at = %s"
+    values = [datetime.now()]
+
+    if has_subscribed is not None:
+        query += ", has_subscribed = %s"
+        values.append(has_subscribed)
+    if user_name:
+        query += ", user_name = %s"
+        values.append(user_name)
+    if phone_number:
+        query += ", phone_number = %s"
+        values.append(phone_number)
+    if credits is not None:
+        query += ", credits = %s"
+        values.append(credits)
+
+    query += f" WHERE user_id = %s RETURNING {USER_COLUMNS}"
+    values.append(user_id)
+    return query, tuple(values)
+
 def get_user(user_id: int) -> Optional[UserInfo]:
-    conn = connect_db()
-    if conn is None:
-        return None
-    try:
-        cur = conn.cursor()
-        query = """
-        SELECT user_id, has_subscribed, user_name, phone_number, created_at, updated_at, gender, credits, role
-        FROM users
-        WHERE user_id = %s;
-        """
-        cur.execute(query, (user_id,))
-        row = cur.fetchone()
-        if row:
-            return UserInfo(
-                user_id=row[0],
-                has_subscribed=row[1],
-                user_name=row[2],
-                phone_number=row[3],
-                created_at=row[4],
-                updated_at=row[5],
-                gender=row[6],
-                credits=row[7],
-                role=row[8],
-            )
-        else:
-            logger.info(f"No user found with ID {user_id}")
+    with get_connection() as conn:
+        if conn is None:
             return None
+        try:
+            cur = conn.cursor()
+            cur.execute(GET_USER_QUERY, (user_id,))
+            row = cur.fetchone()
+            if row:
+                return _row_to_user_info(row)
+            else:
+                logger.info(f"No user found with ID {user_id}")
+                return None
+        except Exception as e:
+            logger.error(f"Error fetching user: {e}")
+            return None
+
+def insert_user(user_id: int, has_subscribed: bool, user_name: str, phone_number: str, credits: int, role: str=UserRole.REGULAR.value):
+    with get_connection() as conn:
+        if conn is None:
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute(INSERT_USER_QUERY, (user_id, has_subscribed, user_name, phone_number, credits, datetime.now(), datetime.now(), role))
+            conn.commit()
+            user_info_cache.invalidate_sync(user_id)
+            logger.info(f"User with ID {user_id} inserted successfully.")
+        except Exception as e:
+            logger.info(f"Error inserting user {user_id}: {e}")
+
+def update_user(user_id: int, has_subscribed: bool=None, user_name: str=None, phone_number: str=None, credits: int=None):
+    with get_connection() as conn:
+        if conn is None:
+            return
+        try:
+            cur = conn.cursor()
+            query, values = _build_update_query(user_id, has_subscribed, user_name, phone_number, credits)
+            cur.execute(query, values)
+            conn.commit()
+            user_info_cache.invalidate_sync(user_id)
+            logger.info(f"User with ID {user_id} updated successfully.")
+        except Exception as e:
+            logger.info(f"Error updating user {user_id}: {e}")
+
+async def get_user_async(user_id: int) -> Optional[UserInfo]:
+    user_info = await user_info_cache.get(user_id)
+    if user_info is not None:
+        return user_info
+    try:
+        async with get_async_connection() as conn:
+            cur = await conn.execute(GET_USER_QUERY, (user_id,))
+            row = await cur.fetchone()
     except Exception as e:
         logger.error(f"Error fetching user: {e}")
         return None
-    finally:
-        conn.close()
+    if row:
+        user_info = _row_to_user_info(row)
+        await user_info_cache.put(user_info)
+        return user_info
+    logger.info(f"No user found with ID {user_id}")
+    return None
 
-def insert_user(user_id: int, has_subscribed: bool, user_name: str, phone_number: str, credits: int, role: str=UserRole.REGULAR.value):
-    conn = connect_db()
-    if conn is None:
-        return
+async def insert_user_async(user_id: int, has_subscribed: bool, user_name: str, phone_number: str, credits: int, role: str=UserRole.REGULAR.value):
     try:
-        cur = conn.cursor()
-        query = """
-        INSERT INTO users (user_id, has_subscribed, user_name, phone_number, credits, created_at, updated_at, role)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-        """
-        cur.execute(query, (user_id, has_subscribed, user_name, phone_number, credits, datetime.now(), datetime.now(), role))
-        conn.commit()
+        async with get_async_connection() as conn:
+            cur = await conn.execute(INSERT_USER_QUERY, (user_id, has_subscribed, user_name, phone_number, credits, datetime.now(), datetime.now(), role))
+            row = await cur.fetchone()
+        await user_info_cache.put(_row_to_user_info(row))
         logger.info(f"User with ID {user_id} inserted successfully.")
     except Exception as e:
+        await user_info_cache.invalidate(user_id)
         logger.info(f"Error inserting user {user_id}: {e}")
-    finally:
-        conn.close()
 
-def update_user(user_id: int, has_subscribed: bool=None, user_name: str=None, phone_number: str=None, credits: int=None):
-    conn = connect_db()
-    if conn is None:
-        return
+async def update_user_async(user_id: int, has_subscribed: bool=None, user_name: str=None, phone_number: str=None, credits: int=None):
     try:
-        cur = conn.cursor()
-        query = "UPDATE users SET updated_at = %s"
-        values = [datetime.now()]
-
-        if has_subscribed is not None:
-            query += ", has_subscribed = %s"
-            values.append(has_subscribed)
-        if user_name:
-            query += ", user_name = %s"
-            values.append(user_name)
-        if phone_number:
-            query += ", phone_number = %s"
-            values.append(phone_number)
-        if credits:
-            query += ", credits = %s"
-            values.append(credits)
-
-        query += " WHERE user_id = %s"
-        values.append(user_id)
-
-        cur.execute(query, tuple(values))
-        conn.commit()
+        async with get_async_connection() as conn:
+            query, values = _build_update_query(user_id, has_subscribed, user_name, phone_number, credits)
+            cur = await conn.execute(query, values)
+            row = await cur.fetchone()
+        if row:
+            await user_info_cache.put(_row_to_user_info(row))
         logger.info(f"User with ID {user_id} updated successfully.")
     except Exception as e:
+        await user_info_cache.invalidate(user_id)
         logger.info(f"Error updating user {user_id}: {e}")
-    finally:
-        conn.close()
+
+APPLY_DEBITS_QUERY = f"""
+UPDATE users SET credits = users.credits - debits.amount, updated_at = %s
+FROM unnest(%s::bigint[], %s::bigint[]) AS debits(user_id, amount)
+WHERE users.user_id = debits.user_id
+RETURNING {", ".join(f"users.{column.strip()}" for column in USER_COLUMNS.split(","))};
+"""
+
+async def apply_debits_async(conn, debits: Dict[int, int]) -> List[UserInfo]:
+    """Subtract debits from many users in one statement, inside the caller's transaction."""
+    user_ids = list(debits.keys())
+    amounts = [debits[user_id] for user_id in user_ids]
+    cur = await conn.execute(APPLY_DEBITS_QUERY, (datetime.now(), user_ids, amounts))
+    return [_row_to_user_info(row) for row in await cur.fetchall()]
 
 def delete_user(user_id: int):
-    conn = connect_db()
-    if conn is None:
-        return
-    try:
-        cur = conn.cursor()
-        query = "DELETE FROM users WHERE user_id = %s;"
-        cur.execute(query, (user_id,))
-        conn.commit()
-        print(f"User with ID {user_id} deleted successfully.")
-    except Exception as e:
-        print(f"Error deleting user: {e}")
-    finally:
-        conn.close()
+    with get_connection() as conn:
+        if conn is None:
+            return
+        try:
+            cur = conn.cursor()
+            query = "DELETE FROM users WHERE user_id = %s;"
+            cur.execute(query, (user_id,))
+            conn.commit()
+            user_info_cache.invalidate_sync(user_id)
+            print(f"User with ID {user_id} deleted successfully.")
+        except Exception as e:
+            print(f"Error deleting user: {e}")
 
 def fetch_all_users():
-    conn = connect_db()
-    if conn is None:
-        return
-    try:
-        cur = conn.cursor()
-        query = "SELECT * FROM users;"
-        cur.execute(query)
-        users = cur.fetchall()
-        for user in users:
-            print(user)
-    except Exception as e:
-        print(f"Error fetching users: {e}")
-    finally:
-        conn.close()
+    with get_connection() as conn:
+        if conn is None:
+            return
+        try:
+            cur = conn.cursor()
+            query = "SELECT * FROM users;"
+            cur.execute(query)
+            users = cur.fetchall()
+            for user in users:
+                print(user)
+        except Exception as e:
+            print(f"Error fetching users: {e}")
 
 if __name__ == "__main__":
     # Insert a new user
@@ -1,4 +1,5 @@
 import redis
+import redis.asyncio as aioredis
 import json
 from typing import Any, Dict, List, Optional, Union
 
@@ -266,6 +267,32 @@ redis_client = redis.Redis(
         )
 logger.info("Connected to Redis")
 
+# Shared asyncio client for coroutines. The pool is bounded: once max_connections are
+# checked out, callers wait up to pool_timeout seconds for a free connection instead of
+# opening new sockets without limit.
+async_redis_pool = aioredis.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=0,
+            password=None,
+            max_connections=config.redis_settings['max_connections'],
+            timeout=config.redis_settings['pool_timeout'],
+            decode_responses=True
+        )
+async_redis_client = aioredis.Redis(connection_pool=async_redis_pool)
+
+# Same as above but binary-safe: replies come back as raw bytes, for payloads such as voice and images
+async_redis_binary_pool = aioredis.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=0,
+            password=None,
+            max_connections=config.redis_settings['max_connections'],
+            timeout=config.redis_settings['pool_timeout'],
+            decode_responses=False
+        )
+async_redis_binary_client = aioredis.Redis(connection_pool=async_redis_binary_pool)
+
 def basic_examples():
     # Initialize the client (connects to your forwarded Redis server)
     redis = RedisClient(host='localhost', port=6379)
@@ -4,9 +4,9 @@ import re
 
 import py_trees
 
-from src.agent.agent_service import agent_service
 from src.data.Message import Message, MessageType
 from src.agent.user_session import UserSession
+from src.service.user_message_processor import UserMessageProcessor
 from src.utils.constants import Role
 from src.utils.logger import logger
 from src.utils.utils import send_message
@@ -96,7 +96,7 @@ class AskingForReply(BaseActiveBehavior):
             return False
 
     def to_continue(self) -> bool:
-        last_message = self.user_session.context[-1]
+        last_message = self.user_session.context_window[-1]
         if last_message["role"] == Role.USER.value:
             return False
         if not self.is_last_sentence_question(last_message["content"]):
@@ -109,6 +109,6 @@ class AskingForReply(BaseActiveBehavior):
         return is_idle
 
     async def generate_message(self) -> Message:
-        message = await agent_service.generate_reply(self.user_session, self.prompt)
+        message = await UserMessageProcessor.submit_proactive(self.user_session.user_id, self.prompt)
         return message
 
@@ -1,9 +1,9 @@
 import random
 
-from src.agent.agent_service import agent_service
 from src.service.behavior.active_behaviors.base_active_behavior import BaseActiveBehavior
 from src.data.Message import Message, MessageType
 from src.agent.user_session import UserSession
+from src.service.user_message_processor import UserMessageProcessor
 from src.utils.config import config
 from src.utils.utils import get_current_time
 
@@ -38,10 +38,10 @@ class Greetings(BaseActiveBehavior):
         hour, minute = get_current_time()
         if hour == 8:
             self.good_night_minute = random.randint(0, 59)
-            res = await agent_service.generate_reply(self.user_session, self.good_morning_prompt)
+            res = await UserMessageProcessor.submit_proactive(self.user_session.user_id, self.good_morning_prompt)
             return res
         if hour == self.good_night_hour:
             self.good_morning_minute = random.randint(0, 20)
-            res = await agent_service.generate_reply(self.user_session, self.good_night_prompt)
+            res = await UserMessageProcessor.submit_proactive(self.user_session.user_id, self.good_night_prompt)
             return res
         return Message(MessageType.NONE, "This is a none message", "", self.user_session.user_id)
\ No newline at end of file
@@ -1,9 +1,9 @@
 from sphinx.util import requests
 
-from src.agent.agent_service import agent_service
 from src.service.behavior.active_behaviors.base_active_behavior import BaseActiveBehavior
 from src.data.Message import Message
 from src.agent.user_session import UserSession
+from src.service.user_message_processor import UserMessageProcessor
 from src.utils.config import config
 
 
@@ -25,7 +25,7 @@ class ReadNews(BaseActiveBehavior):
 
     async def generate_message(self) -> Message:
         prompt = self.prompt_1 + self._pull_news() + self.prompt_2
-        message: Message = await agent_service.generate_reply(self.user_session, prompt)
+        message: Message = await UserMessageProcessor.submit_proactive(self.user_session.user_id, prompt)
         return message
 
     # TODO: Make it async
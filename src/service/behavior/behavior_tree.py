@@ -12,6 +12,7 @@ import py_trees
 from src.agent.user_session import UserSessionManager, UserSession
 from telegram.ext import ContextTypes
 
+from src.utils.config import config
 from src.utils.logger import logger
 
 
@@ -68,11 +69,22 @@ def create_conversation_tree(user_session: UserSession, bot) -> BehaviourTree:
 class BehaviorTreeManager:
     def __init__(self):
         self.trees: dict[int, list[BehaviourTree]] = {}
+        self.tree_sessions: dict[int, UserSession] = {}
+        # Every tree only acts on users idle for at least this long (the greeting interval is the shortest)
+        self.min_idle_minutes: int = config.greeting_settings["greeting_interval_minutes"]
+        # Trees hold their session, so drop them when the session is evicted
+        UserSessionManager.eviction_listeners.append(self.drop_trees)
+
+    def drop_trees(self, user_id: int):
+        self.trees.pop(user_id, None)
+        self.tree_sessions.pop(user_id, None)
 
     def update_all(self, context: ContextTypes.DEFAULT_TYPE):
-        users = UserSessionManager.get_all_sessions()
+        users = UserSessionManager.get_idle_user_session(0, self.min_idle_minutes)
         for user in users:
-            if user.user_id not in self.trees:
+            # Rebuild the trees of a session that was reloaded after eviction
+            if self.tree_sessions.get(user.user_id) is not user:
+                self.tree_sessions[user.user_id] = user
                 # active_tree = create_active_behavior_tree(user, context.bot)
                 greeting_tree = create_greeting_tree(user, context.bot)
                 conversation_tree = create_conversation_tree(user, context.bot)
@@ -1,4 +1,5 @@
-from src.data.user_info import get_user, UserInfo, update_user
+from src.data.credit_ledger import credit_ledger
+from src.data.user_info import get_user_async, UserInfo
 from src.data.Message import Message, MessageType
 from src.utils.config import config
 from src.utils.constants import UserRole
@@ -7,8 +8,8 @@ image_generation_cost = config.credits_settings['image_generation_cost']
 llm_cost = config.credits_settings['llm_cost']
 voice_message_cost = config.credits_settings['voice_message_cost']
 
-def charge_user(user_id: int, message: Message):
-    if message.message_type == MessageType.BAD_MESSAGE:
+async def charge_user(user_id: int, message: Message):
+    if message.message_type == MessageType.BAD_MESSAGE or not message.billable:
         return
     total_cost = llm_cost
     if message.message_type == MessageType.VOICE:
@@ -16,10 +17,10 @@ def charge_user(user_id: int, message: Message):
     if message.message_type == MessageType.IMAGE:
         total_cost += image_generation_cost
 
-    user_info: UserInfo = get_user(user_id)
+    # Served from the user cache in the common case, so the debit is the only round trip
+    user_info: UserInfo = await get_user_async(user_id)
     if user_info is None:
         return
     if user_info.role == UserRole.ADMIN.value:
         return
-    credits_after_charge = user_info.credits - total_cost
-    update_user(user_id, credits=credits_after_charge)
\ No newline at end of file
+    await credit_ledger.debit(user_id, total_cost)
@@ -22,8 +22,8 @@ class COMMAND(Enum):
     ENABLE_IMAGE = "enable-image"
     DISABLE_IMAGE = "disable-image"
 
-def run_command(user_id, command: str, arguments: list[str]) -> str:
-    user_session = UserSessionManager.get_session(user_id)
+async def run_command(user_id, command: str, arguments: list[str]) -> str:
+    user_session = await UserSessionManager.get_session(user_id)
     try:
         match command.lower():
             case COMMAND.HELP.value:
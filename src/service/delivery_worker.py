@@ -0,0 +1,285 @@
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Optional, List, Tuple
+
+from src.data.blob_store import blob_store
+from src.data.Message import Message, chat_message_store, chat_message_stream
+from src.data.message_history import history_writer
+from src.service.billing import charge_user
+from src.utils.config import config
+from src.utils.logger import logger
+from src.utils.utils import send_message
+
+
+async def deliver_message(bot, user_id: int, message: Message):
+    await send_message(bot, user_id, message)
+    logger.info(f"Sent a {message.message_type.value} message to {user_id}")
+    await charge_user(user_id, message)
+    # The queue entry's reference to a media blob passes on to the history row
+    await history_writer.write(message)
+
+
+async def deliver_messages(bot, user_id: int, messages: list[Message]):
+    # Messages of one user are sent in order
+    for message in messages:
+        await deliver_message(bot, user_id, message)
+
+
+class DeliveryWorker:
+    """
+    Push-based outbound delivery. A listener blocks on the pending-user index (BZPOPMIN)
+    and hands every user that gets a message to a per-user task, so replies go out as
+    soon as they are enqueued instead of on the next polling tick.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._batch_size: int = config.cronjob_settings['delivery_batch_size']
+        self._block_timeout: int = config.cronjob_settings['delivery_block_timeout']
+        self._sweep_interval: int = config.cronjob_settings['delivery_sweep_interval']
+        self._user_tasks: Dict[int, asyncio.Task] = {}
+        self._listener_task: Optional[asyncio.Task] = None
+        self._sweeper_task: Optional[asyncio.Task] = None
+        self._claim_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        logger.info("Starting push-based delivery worker")
+        # Media in the queue are files in the local blob store
+        await blob_store.claim_host()
+        self._claim_task = asyncio.create_task(blob_store.hold_host())
+        self._listener_task = asyncio.create_task(self._listen())
+        self._sweeper_task = asyncio.create_task(self._sweep())
+
+    async def stop(self):
+        tasks = [t for t in (self._listener_task, self._sweeper_task, self._claim_task) if t is not None]
+        tasks += list(self._user_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Delivery worker stopped")
+
+    async def _listen(self):
+        while True:
+            try:
+                user_id = await chat_message_store.wait_for_pending_user(self._block_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Delivery worker failed to read the pending index: {e}")
+                await asyncio.sleep(1)
+                continue
+            if user_id is not None:
+                self._dispatch(user_id)
+
+    async def _sweep(self):
+        # Safety net for users left in the index while the listener could not read it. A failed
+        # delivery puts its user back in the index, so the index is all there is to sweep.
+        while True:
+            await asyncio.sleep(self._sweep_interval)
+            try:
+                for user_id in await chat_message_store.get_pending_user_ids():
+                    self._dispatch(user_id)
+            except Exception as e:
+                logger.error(f"Delivery sweep failed: {e}")
+
+    def _dispatch(self, user_id: int):
+        # A running task keeps draining until the queue is empty, so it will pick up the new message
+        task = self._user_tasks.get(user_id)
+        if task is not None and not task.done():
+            return
+        self._user_tasks[user_id] = asyncio.create_task(self._deliver(user_id))
+
+    async def _deliver(self, user_id: int):
+        try:
+            while True:
+                messages = await chat_message_store.dequeue_batch(user_id, self._batch_size)
+                if not messages:
+                    break
+                await deliver_messages(self.bot, user_id, messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to deliver messages to {user_id}: {e}")
+            # Back off before the retry; _dispatch skips the user while this task is running
+            await asyncio.sleep(self._block_timeout)
+            failed = True
+        else:
+            failed = False
+        finally:
+            self._user_tasks.pop(user_id, None)
+        if failed:
+            # The rest of the queue was taken off the index with the first pop
+            try:
+                await chat_message_store.mark_pending(user_id)
+            except Exception as e:
+                logger.error(f"Failed to mark {user_id} as pending again: {e}")
+            return
+        # A message enqueued after the last, empty pop was handed to _dispatch while this task
+        # was still running, so _dispatch left it to this task. Look again now that it is gone.
+        try:
+            if await chat_message_store.get_length(user_id) > 0:
+                self._dispatch(user_id)
+        except Exception as e:
+            logger.error(f"Failed to check the queue of {user_id}: {e}")
+
+
+class _Partition:
+    """What one stream consumer holds of its partition: the entries read but not yet sent, per user."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.consumer = chat_message_stream.new_consumer_name(index)
+        self.user_queues: Dict[int, Deque[Tuple[str, Message]]] = {}
+        self.user_tasks: Dict[int, asyncio.Task] = {}
+        self.space = asyncio.Event()
+
+    def entry_ids(self) -> List[str]:
+        return [entry_id for queue in self.user_queues.values() for entry_id, _ in queue]
+
+    def buffered(self) -> int:
+        return sum(len(queue) for queue in self.user_queues.values())
+
+    def drop(self):
+        """Forget the entries read so far; whoever holds the partition next claims them once they go idle."""
+        for task in self.user_tasks.values():
+            task.cancel()
+        self.user_tasks.clear()
+        self.user_queues.clear()
+
+
+class StreamDeliveryWorker:
+    """
+    Delivery from the outbound Redis Streams through a consumer group. This worker runs a
+    consumer for every partition and delivers from the partitions whose lease it gets. A
+    consumer keeps reading while it sends: every user has a task of its own that sends the
+    user's entries in order and acks each one after Telegram accepted it, retrying a failed
+    send up to delivery_max_attempts times. Entries a dead process left unacked are
+    reclaimed with XAUTOCLAIM. Any number of these workers, in one or many processes, can
+    share the streams; processes on other hosts only if the blob store is on shared storage
+    (see BlobStore.claim_host).
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._batch_size: int = config.cronjob_settings['delivery_batch_size']
+        self._block_timeout: int = config.cronjob_settings['delivery_block_timeout']
+        self._claim_idle_ms: int = config.cronjob_settings['delivery_claim_idle_seconds'] * 1000
+        self._max_attempts: int = config.cronjob_settings['delivery_max_attempts']
+        self._partitions: Dict[int, _Partition] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        logger.info(f"Starting stream delivery worker for {chat_message_stream.partitions} partitions")
+        # Entries only carry the digest of their media, which must be readable from this host
+        await blob_store.claim_host()
+        self._tasks.append(asyncio.create_task(blob_store.hold_host()))
+        await chat_message_stream.ensure_group()
+        for index in range(chat_message_stream.partitions):
+            partition = self._partitions[index] = _Partition(index)
+            self._tasks.append(asyncio.create_task(self._consume(partition)))
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        for partition in self._partitions.values():
+            tasks += list(partition.user_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Stream delivery worker stopped")
+
+    async def _consume(self, partition: _Partition):
+        loop = asyncio.get_running_loop()
+        next_claim = next_keep_alive = 0.0
+        while True:
+            try:
+                held = await chat_message_stream.hold_partition(partition.index, partition.consumer)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Consumer {partition.consumer} failed to renew its partition lease: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not held:
+                if partition.user_queues:
+                    logger.warning(f"Consumer {partition.consumer} lost partition {partition.index}")
+                    partition.drop()
+                await asyncio.sleep(self._block_timeout)
+                continue
+
+            try:
+                now = loop.time()
+                if now >= next_keep_alive:
+                    await chat_message_stream.keep_alive(partition.index, partition.consumer, *partition.entry_ids())
+                    next_keep_alive = now + self._claim_idle_ms / 3000
+                if partition.buffered() >= self._batch_size:
+                    # Read no further ahead than one batch; wake up in time to keep the entries alive
+                    partition.space.clear()
+                    try:
+                        await asyncio.wait_for(partition.space.wait(), self._block_timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                entries = []
+                if now >= next_claim:
+                    entries = await chat_message_stream.claim_stale(partition.index, partition.consumer,
+                                                                    self._claim_idle_ms, self._batch_size,
+                                                                    self._max_attempts)
+                    if entries:
+                        logger.info(f"Reclaimed {len(entries)} stale outbound messages of partition {partition.index}")
+                    else:
+                        next_claim = now + self._claim_idle_ms / 1000
+                if not entries:
+                    entries = await chat_message_stream.read(partition.index, partition.consumer,
+                                                             self._batch_size - partition.buffered(),
+                                                             self._block_timeout * 1000)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Consumer {partition.consumer} failed to read the outbound stream: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for entry_id, message in entries:
+                partition.user_queues.setdefault(message.user_id, deque()).append((entry_id, message))
+                task = partition.user_tasks.get(message.user_id)
+                if task is None or task.done():
+                    partition.user_tasks[message.user_id] = asyncio.create_task(
+                        self._deliver_user(partition, message.user_id))
+
+    async def _deliver_user(self, partition: _Partition, user_id: int):
+        queue = partition.user_queues[user_id]
+        attempts = 0
+        try:
+            while queue:
+                entry_id, message = queue[0]
+                try:
+                    await deliver_message(self.bot, user_id, message)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    attempts += 1
+                    if attempts < self._max_attempts:
+                        # The user's later entries wait, so they still go out in order
+                        logger.error(f"Failed to deliver message {entry_id} to {user_id}, retrying: {e}")
+                        await asyncio.sleep(min(2 ** attempts, self._block_timeout))
+                        continue
+                    logger.error(f"Dropping outbound message {entry_id} after {attempts} failed delivery attempts: {e}")
+                    if message.digest is not None:
+                        await blob_store.release(message.digest)
+                try:
+                    await chat_message_stream.ack(partition.index, entry_id)
+                except Exception as e:
+                    # Stays pending; a later claim delivers it again
+                    logger.error(f"Failed to ack outbound message {entry_id}: {e}")
+                queue.popleft()
+                attempts = 0
+                partition.space.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Whatever is left stops being kept alive and is reclaimed
+            logger.error(f"Stream delivery to {user_id} stopped: {e}")
+        finally:
+            if partition.user_queues.get(user_id) is queue:
+                del partition.user_queues[user_id]
+                partition.user_tasks.pop(user_id, None)
@@ -8,23 +8,29 @@ from telegram import Update, File
 from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, ContextTypes
 
+from src.agent.agent_service import agent_service
 from src.agent.event_generator import EventGenerator
-from src.data.message_history import insert_message
-from src.data.user_info import insert_user, get_user, UserInfo
+from src.data.blob_store import blob_store
+from src.data.credit_ledger import credit_ledger
+from src.data.connect_db import open_async_pool, close_async_pool
+from src.data.message_history import setup_schema, history_writer, maintain_partitions
+from src.data.user_info import insert_user_async, get_user_async, UserInfo
 from src.service.behavior.behavior_tree import push_message
-from src.service.billing import charge_user
-from src.data.Message import chat_message_store, Message
+from src.data.Message import chat_message_store
+from src.service.delivery_worker import DeliveryWorker, StreamDeliveryWorker, deliver_messages
 from src.service.user_message_processor import UserMessageProcessor
 from src.agent.user_session import UserSessionManager
 from src.utils.config import config
 from src.utils.logger import logger
-from src.utils.utils import send_message
 
 
 class TelegramBot:
     def __init__(self, token: str):
         self.token = token
-        self.app = Application.builder().token(token).build()
+        self.app = (Application.builder().token(token)
+                    .post_init(TelegramBot.post_init)
+                    .post_shutdown(TelegramBot.post_shutdown)
+                    .build())
         self.register_handlers()
 
     @staticmethod
@@ -33,12 +39,12 @@ class TelegramBot:
         command = update.message.text
         if command.startswith('/'):
             command = command[1:]
-        res = UserMessageProcessor.process_command(user_id, command)
+        res = await UserMessageProcessor.process_command(user_id, command)
         await context.bot.send_message(chat_id=user_id, text=res)
 
     @staticmethod
     async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_info = TelegramBot.register_user(update)
+        user_info = await TelegramBot.register_user(update)
         user_id = update.message.chat_id
         await context.bot.send_chat_action(chat_id=user_id, action=ChatAction.TYPING)
         text = update.message.text
@@ -46,7 +52,7 @@ class TelegramBot:
 
     @staticmethod
     async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_info = TelegramBot.register_user(update)
+        user_info = await TelegramBot.register_user(update)
         user_id = update.message.chat_id
         await context.bot.send_chat_action(chat_id=user_id, action=ChatAction.TYPING)
         voice = update.message.voice
@@ -58,7 +64,7 @@ class TelegramBot:
 
     @staticmethod
     async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_info = TelegramBot.register_user(update)
+        user_info = await TelegramBot.register_user(update)
         user_id = user_info.user_id
         await context.bot.send_chat_action(chat_id=user_id, action=ChatAction.TYPING)
         image_file = await update.message.photo[-1].get_file()
@@ -70,19 +76,15 @@ class TelegramBot:
 
     @staticmethod
     async def process_messages(context: ContextTypes.DEFAULT_TYPE) -> None:
-        async def process_message(bot, user_id: int, message: Message):
-            await send_message(bot, user_id, message)
-            logger.info(f"Sent a {message.message_type.value} message to {user_id}")
-            insert_message(message)
         tasks = []
-        for user_id in UserSessionManager.get_all_user_id():
-            while chat_message_store.get_length(user_id) > 0:
-                message = chat_message_store.dequeue(user_id)
-                charge_user(user_id, message)
-                task = asyncio.create_task(
-                    process_message(context.bot, user_id, message)
-                )
-                tasks.append(task)
+        batch_size = config.cronjob_settings['delivery_batch_size']
+        pending_user_ids = await chat_message_store.get_pending_user_ids()
+        batches = await chat_message_store.dequeue_many(pending_user_ids, batch_size)
+        for user_id, messages in batches.items():
+            task = asyncio.create_task(
+                deliver_messages(context.bot, user_id, messages)
+            )
+            tasks.append(task)
         # await asyncio.gather(*tasks)
 
     @staticmethod
@@ -90,18 +92,36 @@ class TelegramBot:
         await EventGenerator.generate_events()
 
     @staticmethod
-    def register_user(update: Update) -> UserInfo:
+    async def collect_blob_garbage(context: ContextTypes.DEFAULT_TYPE) -> None:
+        await blob_store.collect_garbage()
+
+    @staticmethod
+    async def maintain_history(context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            await maintain_partitions()
+        except Exception as e:
+            logger.error(f"Message history maintenance failed: {e}")
+
+    @staticmethod
+    async def settle_credits(context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            await credit_ledger.settle()
+        except Exception as e:
+            logger.error(f"Credit settlement failed: {e}")
+
+    @staticmethod
+    async def register_user(update: Update) -> UserInfo:
         user_id = update.message.chat_id
-        user_info = get_user(user_id)
+        user_info = await get_user_async(user_id)
         # Register User
         if user_info is None:
             user_full_name = update.message.from_user.full_name
-            user_session = UserSessionManager.get_session(user_id)
+            user_session = await UserSessionManager.get_session(user_id)
             if user_session.full_name != user_full_name:
                 user_session.full_name = user_full_name
-            insert_user(user_id, True, user_name=user_full_name, phone_number="", credits=config.credits_settings["default_user_credits"])
-            user_info = get_user(user_id)
-        return user_info
+            await insert_user_async(user_id, True, user_name=user_full_name, phone_number="", credits=config.credits_settings["default_user_credits"])
+            user_info = await get_user_async(user_id)
+        return await credit_ledger.with_pending_debits(user_info)
 
     def register_handlers(self):
         self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, TelegramBot.handle_text, block=False))
@@ -110,12 +130,53 @@ class TelegramBot:
         self.app.add_handler(MessageHandler(filters.COMMAND, TelegramBot.handle_command, block=False))
         logger.info("Registering handlers finished")
 
+    @staticmethod
+    async def post_init(application: Application) -> None:
+        await open_async_pool()
+        # The partition of the current month must exist before the first history write. If
+        # Postgres is unavailable, start anyway; the daily maintenance job tries again.
+        await TelegramBot.maintain_history(None)
+        await history_writer.start()
+        UserSessionManager.start_flusher()
+        application.create_task(UserSessionManager.preload())
+        match config.cronjob_settings['delivery_mode']:
+            case "push":
+                delivery_worker = DeliveryWorker(application.bot)
+            case "stream":
+                delivery_worker = StreamDeliveryWorker(application.bot)
+            case _:
+                return
+        await delivery_worker.start()
+        application.bot_data["delivery_worker"] = delivery_worker
+
+    @staticmethod
+    async def post_shutdown(application: Application) -> None:
+        delivery_worker = application.bot_data.get("delivery_worker")
+        if delivery_worker is not None:
+            await delivery_worker.stop()
+        await UserMessageProcessor.stop()
+        await history_writer.stop()
+        await agent_service.context_compactor.stop()
+        await UserSessionManager.stop_flusher()
+        await credit_ledger.settle()
+        await close_async_pool()
+
     def start(self):
         logger.info("Starting telegram bot")
+        setup_schema()
+        credit_ledger.setup_schema()
         job_queue = self.app.job_queue
         interval = config.cronjob_settings['interval'] # In seconds
-        job_queue.run_repeating(TelegramBot.process_messages, interval=3, first=0)
+        if config.cronjob_settings['delivery_mode'] == "poll":
+            # Fallback: the push or stream delivery worker is started in post_init otherwise
+            job_queue.run_repeating(TelegramBot.process_messages,
+                                    interval=config.cronjob_settings['delivery_poll_interval'], first=0)
         job_queue.run_repeating(TelegramBot.generate_events, interval=100 * 60, first=0)
+        job_queue.run_repeating(TelegramBot.collect_blob_garbage,
+                                interval=config.blob_store_settings['gc_interval_seconds'])
+        job_queue.run_repeating(TelegramBot.maintain_history, interval=24 * 60 * 60)
+        job_queue.run_repeating(TelegramBot.settle_credits,
+                                interval=config.credits_settings['settlement_interval_seconds'])
         self.app.run_polling()
 
 if __name__ == '__main__':
@@ -1,64 +1,262 @@
 import asyncio
 import io
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Tuple, Union
 
 from src.data.user_info import UserInfo, verify_user
 from src.agent.agent_service import agent_service
 from src.service.commands_handler import run_command
 from src.data.Message import Message, chat_message_store, MessageType
 from src.agent.user_session import UserSessionManager
+from src.utils.config import config
 from src.utils.constants import UserRole
+from src.utils.logger import logger
+
+
+@dataclass(frozen=True)
+class ProactivePrompt:
+    """A prompt for a message the bot sends on its own, e.g. a greeting or a life event."""
+    text: str
+
+
+# What the user said, or a task still working it out (e.g. transcribing a voice message),
+# or a proactive prompt, and the future its caller waits on for the reply
+UserInput = Tuple[Union[str, asyncio.Future, ProactivePrompt], asyncio.Future]
 
 
 class UserMessageProcessor:
+    """
+    Every user has a mailbox of inputs that an actor task works through one turn at a time,
+    so two messages sent in quick succession never generate replies over the same context
+    at once. Different users have their own actors and run in parallel. Work that does not
+    touch the context, like transcribing a voice message, starts as soon as the message
+    arrives and overlaps with the turn in progress.
+
+    Users often send a few short messages in a row. A turn starts only once no new input
+    arrived for `coalesce_window_seconds`, and answers everything in the mailbox at once
+    with a single generation. An input that arrives while a turn is running supersedes it
+    as soon as it turns out to say something (a transcription may come back empty): the
+    turn is cancelled, which cancels its LLM, TTS or image requests too, and its inputs are
+    answered together with the new one by the next turn.
+
+    Messages the bot starts on its own go through the same mailbox (submit_proactive), so
+    they never run over the context at the same time as a reply either. They get a turn of
+    their own, without waiting for the user to go quiet, and a new input supersedes them too.
+    """
+    mailboxes: Dict[int, Deque[UserInput]] = {}
+    _actors: Dict[int, asyncio.Task] = {}
+    _turns: Dict[int, asyncio.Task] = {}
+    _last_arrival: Dict[int, float] = {}
+    coalesce_window: float = config.user_session_settings["coalesce_window_seconds"]
+
     @staticmethod
     async def process_text(user_info: UserInfo, text: str) -> Message:
-        user_session = UserSessionManager.get_session(user_info.user_id)
-        if verify_user(user_info):
-            response = await agent_service.generate_reply(user_session, text)
-            return response
-        else:
-            return UserMessageProcessor.enqueue_bad_message(user_info)
+        if not verify_user(user_info):
+            return await UserMessageProcessor.enqueue_bad_message(user_info)
+        return await UserMessageProcessor.submit(user_info.user_id, text)
 
     @staticmethod
     async def process_voice(user_info: UserInfo, voice_buffer: io.BytesIO) -> Message:
-        user_session = UserSessionManager.get_session(user_info.user_id)
-        if verify_user(user_info):
-            text = await agent_service.transcribe(voice_buffer)
-            response = await agent_service.generate_reply(user_session, text)
-            return response
-        else:
-            return UserMessageProcessor.enqueue_bad_message(user_info)
+        if not verify_user(user_info):
+            return await UserMessageProcessor.enqueue_bad_message(user_info)
+        transcription = asyncio.create_task(agent_service.transcribe(voice_buffer))
+        return await UserMessageProcessor.submit(user_info.user_id, transcription)
 
     @staticmethod
     async def process_image(user_info: UserInfo, image_b64: str) -> Message:
-        user_session = UserSessionManager.get_session(user_info.user_id)
-        if verify_user(user_info):
+        if not verify_user(user_info):
+            return await UserMessageProcessor.enqueue_bad_message(user_info)
+        user_session = await UserSessionManager.get_session(user_info.user_id)
+
+        async def describe() -> str:
             description = await agent_service.describe_image(user_session, image_b64)
-            prompt = "I sent you an image. Here is the description of the image: \n" + description
-            res = await agent_service.generate_reply(user_session, prompt)
-            return res
+            return "I sent you an image. Here is the description of the image: \n" + description
+        return await UserMessageProcessor.submit(user_info.user_id, asyncio.create_task(describe()))
+
+    @staticmethod
+    async def submit(user_id: int, user_input: Union[str, asyncio.Future]) -> Message:
+        """Queue an input behind the user's earlier ones and wait for the reply that answers it."""
+        future = asyncio.get_running_loop().create_future()
+        mailbox = UserMessageProcessor.mailboxes.setdefault(user_id, deque())
+        mailbox.append((user_input, future))
+        UserMessageProcessor._last_arrival[user_id] = time.monotonic()
+        if isinstance(user_input, str):
+            if user_input:
+                UserMessageProcessor._supersede_turn(user_id)
         else:
-            return UserMessageProcessor.enqueue_bad_message(user_info)
+            def on_resolved(task: asyncio.Future):
+                if task.cancelled() or task.exception() is not None or not task.result():
+                    return
+                # Unless a turn has taken it meanwhile, the running turn is an older one
+                if any(queued is user_input for queued, _ in mailbox):
+                    UserMessageProcessor._supersede_turn(user_id)
+            user_input.add_done_callback(on_resolved)
+        UserMessageProcessor._ensure_actor(user_id, mailbox)
+        return await future
+
+    @staticmethod
+    async def submit_proactive(user_id: int, prompt: str) -> Message:
+        """
+        Queue a message the bot starts on its own behind the user's inputs and wait for it.
+        If the user writes while it is being generated, it is dropped and a NONE message returned.
+        """
+        future = asyncio.get_running_loop().create_future()
+        mailbox = UserMessageProcessor.mailboxes.setdefault(user_id, deque())
+        mailbox.append((ProactivePrompt(prompt), future))
+        UserMessageProcessor._ensure_actor(user_id, mailbox)
+        return await future
+
+    @staticmethod
+    def _ensure_actor(user_id: int, mailbox: Deque[UserInput]):
+        if user_id not in UserMessageProcessor._actors:
+            UserMessageProcessor._actors[user_id] = asyncio.create_task(UserMessageProcessor._run_actor(user_id, mailbox))
+
+    @staticmethod
+    def _supersede_turn(user_id: int):
+        turn = UserMessageProcessor._turns.get(user_id)
+        if turn is not None and not turn.done():
+            logger.info(f"User {user_id} sent a new message, cancelling the reply in progress")
+            turn.cancel()
+
+    @staticmethod
+    async def _run_actor(user_id: int, mailbox: Deque[UserInput]):
+        try:
+            # Nothing awaits between the last turn and the cleanup below, so an input
+            # submitted meanwhile either lands in this mailbox or starts a new actor
+            while mailbox:
+                if isinstance(mailbox[0][0], ProactivePrompt):
+                    turn = asyncio.create_task(UserMessageProcessor._run_proactive_turn(user_id, mailbox.popleft()))
+                else:
+                    await UserMessageProcessor._wait_for_quiet(user_id)
+                    # A proactive prompt is never answered together with the user's messages
+                    inputs = []
+                    while mailbox and not isinstance(mailbox[0][0], ProactivePrompt):
+                        inputs.append(mailbox.popleft())
+                    turn = asyncio.create_task(UserMessageProcessor._run_turn(user_id, inputs, mailbox))
+                UserMessageProcessor._turns[user_id] = turn
+                try:
+                    # A superseded turn is cancelled without cancelling the actor
+                    await asyncio.wait([turn])
+                finally:
+                    if not turn.done():
+                        turn.cancel()
+                        await asyncio.wait([turn])
+                    UserMessageProcessor._turns.pop(user_id, None)
+        finally:
+            UserMessageProcessor.mailboxes.pop(user_id, None)
+            UserMessageProcessor._actors.pop(user_id, None)
+            UserMessageProcessor._last_arrival.pop(user_id, None)
+            for _, future in mailbox:
+                future.cancel()
+
+    @staticmethod
+    async def _wait_for_quiet(user_id: int):
+        while True:
+            quiet_at = UserMessageProcessor._last_arrival[user_id] + UserMessageProcessor.coalesce_window
+            delay = quiet_at - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _run_turn(user_id: int, inputs: List[UserInput], mailbox: Deque[UserInput]):
+        texts: List[str] = []
+        futures: List[asyncio.Future] = []
+        in_context = False
+        try:
+            for user_input, future in inputs:
+                try:
+                    # Shielded, so that superseding the turn doesn't throw away a transcription
+                    text = user_input if isinstance(user_input, str) else await asyncio.shield(user_input)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Failed to read a message of user {user_id}: {e}")
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if text:
+                    texts.append(text)
+                # A caller that is gone, e.g. because its handler was cancelled, is still
+                # answered as part of the turn
+                futures.append(future)
+            if not texts:
+                for future in futures:
+                    if not future.done():
+                        future.set_result(Message(MessageType.NONE, "", "", user_id))
+                return
+            if len(texts) > 1:
+                logger.info(f"Answering {len(texts)} messages of user {user_id} in one turn")
+            user_session = await UserSessionManager.get_session(user_id)
+            # generate_reply adds the texts to the context before it first awaits
+            in_context = True
+            result = await agent_service.generate_reply(user_session, "\n".join(texts))
+        except asyncio.CancelledError:
+            # Hand the inputs on to the next turn. Once they are in the context, the next
+            # turn answers them without adding them again.
+            if in_context:
+                carried = [("", future) for future in futures if not future.done()]
+            else:
+                carried = [(user_input, future) for user_input, future in inputs if not future.done()]
+            mailbox.extendleft(reversed(carried))
+            raise
+        except Exception as e:
+            logger.error(f"Failed to process messages of user {user_id}: {e}")
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in futures:
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    async def _run_proactive_turn(user_id: int, proactive: UserInput):
+        prompt, future = proactive
+        try:
+            user_session = await UserSessionManager.get_session(user_id)
+            result = await agent_service.generate_reply(user_session, prompt.text)
+        except asyncio.CancelledError:
+            # Superseded by the user, whose message the next turn answers instead
+            if not future.done():
+                future.set_result(Message(MessageType.NONE, "", "", user_id))
+            raise
+        except Exception as e:
+            logger.error(f"Failed to generate a proactive message for user {user_id}: {e}")
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    async def stop():
+        actors = list(UserMessageProcessor._actors.values())
+        for actor in actors:
+            actor.cancel()
+        await asyncio.gather(*actors, return_exceptions=True)
 
     @staticmethod
-    def process_command(user_id, command) -> str:
+    async def process_command(user_id, command) -> str:
         if " " in command:
             command, arguments = command.split(" ")
         else:
             command, arguments = command, ""
         arguments = arguments.lower()
         arguments = arguments.split(" ")
-        return run_command(user_id, command, arguments)
+        return await run_command(user_id, command, arguments)
 
     @staticmethod
-    def enqueue_bad_message(user_info: UserInfo) -> Message:
+    async def enqueue_bad_message(user_info: UserInfo) -> Message:
         message: Message = Message(MessageType.BAD_MESSAGE,
                                    f"Bot cannot reply to your message.\n"
                                    f"Your credits: {user_info.credits}.\n"
                                    f"Your role: {user_info.role}",
                                    "",
                                    user_info.user_id)
-        chat_message_store.enqueue(user_info.user_id, message)
+        await chat_message_store.enqueue(user_info.user_id, message)
         return message
 
 async def main(datetime=None):
@@ -77,7 +275,7 @@ async def main(datetime=None):
     print(res)
     res = await UserMessageProcessor.process_text(user_info, 'What are they?')
     print(res)
-    user_session = UserSessionManager.get_session(user_info.user_id)
+    user_session = await UserSessionManager.get_session(user_info.user_id)
     print(user_session.context)
 
 if __name__ == '__main__':
@@ -17,6 +17,8 @@ class Config:
         # User settings
         self.user_session_settings: dict = {}
 
+        self.user_info_cache_settings: dict = {}
+
         # Credit settings
         self.credits_settings: dict = {}
 
@@ -29,6 +31,7 @@ class Config:
         # Redis and postgres db
         self.redis_settings: dict = {}
         self.postgres_db: dict = {}
+        self.blob_store_settings: dict = {}
 
         # Env and secrets
         self.nvidia_api_key: str = ""
@@ -58,6 +61,7 @@ class Config:
             self.stability_ai_api_settings = config['stability_ai_api_settings']
             # User
             self.user_session_settings = config['user_session_settings']
+            self.user_info_cache_settings = config['user_info_cache_settings']
             # Credit
             self.credits_settings = config['credits_settings']
             # Behavior
@@ -69,6 +73,7 @@ class Config:
             # DB
             self.redis_settings = config['redis_settings']
             self.postgres_db = config['postgres_settings']
+            self.blob_store_settings = config['blob_store_settings']
 
     def load_env(self):
         load_dotenv()
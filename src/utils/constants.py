@@ -6,6 +6,10 @@ class Role(Enum):
     SYSTEM = "system"
     TOOL = "tool"
 
+# Roles as small integers, for compact storage of conversation turns
+ROLE_CODES = {Role.USER: 0, Role.ASSISTANT: 1, Role.SYSTEM: 2, Role.TOOL: 3}
+ROLES_BY_CODE = {code: role for role, code in ROLE_CODES.items()}
+
 class UserRole(Enum):
     ADMIN = "admin"
     REGULAR = "regular"